@@ -0,0 +1,112 @@
+from library import *
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import islice
+import asyncio
+import os
+
+__all__ = ['AsyncTagIO']
+
+class AsyncTagIO():
+    """Asyncio front-end of the parsers and writers.
+    Blocking work runs in a bounded executor (a thread pool of workers by
+    default); at most pending calls are in flight at once, further calls
+    wait for a slot, which keeps backpressure on the callers.
+    """
+    def __init__(self, workers=8, pending=None, executor=None):
+        self._own = executor is None
+        self._executor = executor or ThreadPoolExecutor(workers)
+        self.pending = pending or 4 * workers
+        self._slots = asyncio.Semaphore(self.pending)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        if self._own:
+            await self._call(None, self._executor.shutdown)
+
+    async def _call(self, slots, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        call = partial(func, *args, **kwargs)
+        if slots is None:
+            return await loop.run_in_executor(None, call)
+        async with slots:
+            return await loop.run_in_executor(self._executor, call)
+
+    async def run(self, func, *args, **kwargs):
+        '''Run any blocking function in the executor.
+        '''
+        return await self._call(self._slots, func, *args, **kwargs)
+
+    async def open(self, path, **kwargs):
+        '''Return the context object of an audio file, see open_context.
+        '''
+        return await self.run(open_context, path, **kwargs)
+
+    async def probe(self, path):
+        '''Return the ScanRecord of an audio file, None if it isn't audio.
+        '''
+        return await self.run(read_record, path)
+
+    async def export_picture(self, source, dest):
+        '''Copy the embedded picture of a context or an audio file at path
+        to dest. Return the number of bytes copied.
+        '''
+        if isinstance(source, (str, bytes, os.PathLike)):
+            return await self.run(lambda: open_context(source).export_picture(dest))
+        return await self.run(source.export_picture, dest)
+
+    async def save(self, ctx, *args, **kwargs):
+        '''Call save method of a context with given frames or blocks.
+        '''
+        return await self.run(ctx.save, *args, **kwargs)
+
+    async def apply_edits(self, path, edits, **kwargs):
+        '''Apply edits to an audio file, see library.apply_edits.
+        '''
+        return await self.run(apply_edits, path, edits, **kwargs)
+
+    async def scan(self, paths, chunk=256):
+        '''Asynchronous iterator of ScanRecord objects in completion order.
+        paths is a directory (walked in the executor), an iterable or an
+        asynchronous iterable of file paths. Files which aren't audio are
+        skipped.
+        '''
+        running = set()
+        try:
+            async for path in self._paths(paths, chunk):
+                running.add(asyncio.ensure_future(self.probe(path)))
+                if len(running) >= self.pending:
+                    done, running = await asyncio.wait(
+                        running, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        if task.result() is not None:
+                            yield task.result()
+            while running:
+                done, running = await asyncio.wait(
+                    running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.result() is not None:
+                        yield task.result()
+        finally:
+            for task in running:
+                task.cancel()
+
+    async def _paths(self, paths, chunk):
+        if hasattr(paths, '__aiter__'):
+            async for path in paths:
+                yield path
+            return
+        if isinstance(paths, (str, bytes, os.PathLike)):
+            paths = walk(paths)
+        paths = iter(paths)
+        while True:
+            # directory walking blocks, so take paths chunk by chunk
+            part = await self._call(None, lambda: list(islice(paths, chunk)))
+            if not part: break
+            for path in part:
+                yield path
@@ -0,0 +1,260 @@
+'''Benchmarks on a synthetic corpus.
+
+Run `python bench.py [--quick] [--out FILE] [--dir DIR]` to generate mp3
+(ID3v2.3/2.4) and flac files locally and measure parse latency,
+throughput, tag saving, payload copying and tag building. The results
+are printed (or written to FILE) as JSON, to be compared between versions.
+'''
+from util import *
+from mp3 import ID3TagWriter, build_frame, build_frame_info, create_ID3_tag
+from flac import FlacTagWriter, blockInfo, create_Flac_tag
+from library import open_context, read_record, apply_edits
+import os
+import json
+import time
+import shutil
+import struct
+import platform
+import tempfile
+import tracemalloc
+
+__all__ = ['make_mp3', 'make_flac', 'make_corpus', 'run']
+
+# MPEG-1 Layer III, 128 kbps, 44100 Hz, stereo, no padding: 417 bytes
+_MPEG_HEADER = b'\xff\xfb\x90\x64'
+_MPEG_FRAME = 417
+_TEXT_IDS = ('TIT2', 'TPE1', 'TALB', 'TCON', 'TRCK', 'TYER', 'TCOM',
+             'TPE2', 'TPUB', 'TSSE', 'TCOP', 'TENC')
+
+def _image(size):
+    # bytes looking like a jpeg image of given size
+    size = max(size, 4)
+    return b'\xff\xd8\xff\xe0' + os.urandom(min(size - 4, 4096)) * \
+           ((size - 4) // 4096 + 1)
+
+def make_mp3(path, frames=10, text_size=32, cover_size=0, ver=3,
+             audio_frames=200, padding=1024):
+    '''Write a synthetic mp3 file with frames text frames of text_size
+    characters, an APIC frame of cover_size bytes and audio_frames silent
+    MPEG frames. Return the file size.
+    '''
+    writer = ID3TagWriter(ver, padding)
+    for i in range(frames):
+        text = ('%d ' % i + 'x' * text_size)[:text_size]
+        if i < len(_TEXT_IDS):
+            writer.add_frame(_TEXT_IDS[i], b'\x03' + text.encode())
+        else:
+            writer.add_frame('TXXX', b'\x03' + b'desc%d\x00' % i + text.encode())
+    if cover_size:
+        writer.add_frame('APIC', b'\x00image/jpeg\x00\x03\x00' +
+                         _image(cover_size)[:cover_size])
+    audio = (_MPEG_HEADER + bytes(_MPEG_FRAME - 4)) * audio_frames
+    bytes_to_file(path, *writer.parts(), audio)
+    return os.path.getsize(path)
+
+# Largest picture in a PICTURE block, whose header here takes 42 bytes
+_MAX_FLAC_COVER = 0xffffff - 42
+
+def _streaminfo(rate=44100, channels=2, bps=16, samples=441000):
+    s = rate << 44 | (channels - 1) << 41 | (bps - 1) << 36 | samples
+    return struct.pack('!2H', 4096, 4096) + b'\x00' * 6 + \
+           struct.pack('!Q', s) + bytes(16)
+
+def make_flac(path, comments=10, text_size=32, cover_size=0, seekpoints=0,
+              audio_size=65536, padding=1024):
+    '''Write a synthetic flac file with comments vorbis comments of
+    text_size characters, a PICTURE block of cover_size bytes, a SEEKTABLE
+    of seekpoints points and audio_size bytes of fake frames.
+    cover_size is capped at _MAX_FLAC_COVER, as the length of a metadata
+    block has 24 bits. Return the file size.
+    '''
+    cover_size = min(cover_size, _MAX_FLAC_COVER)
+    writer = FlacTagWriter(padding)
+    writer.add_block(0, _streaminfo())
+    if seekpoints:
+        table = b''.join(struct.pack('!QQH', i * 4096, i * 1000, 4096)
+                         for i in range(seekpoints))
+        writer.add_block(3, table)
+    comm = [('FIELD%d' % i, ('%d ' % i + 'x' * text_size)[:text_size])
+            for i in range(comments)]
+    writer.add(blockInfo(comm))
+    if cover_size:
+        image = _image(cover_size)[:cover_size]
+        writer.add_block(6, b''.join((
+            struct.pack('!2I', 3, 10), b'image/jpeg',
+            struct.pack('!6I', 0, 0, 0, 0, 0, len(image)), image)))
+    audio = b'\xff\xf8' + bytes(max(audio_size - 2, 0))
+    bytes_to_file(path, *writer.parts(), audio)
+    return os.path.getsize(path)
+
+def make_corpus(dirpath, count=20, cover_sizes=(1024,), frame_counts=(10,),
+                seekpoints=(0,), comments=(10,)):
+    '''Generate count files of each combination of parameters, half mp3
+    (v2.3 and v2.4) and half flac, into dirpath. Return their paths.
+    '''
+    os.makedirs(dirpath, exist_ok=True)
+    paths = []
+    for cover in cover_sizes:
+        for n in frame_counts:
+            for points in seekpoints:
+                for m in comments:
+                    for i in range(count):
+                        name = f'c{cover}_f{n}_s{points}_m{m}_{i}'
+                        if i % 2:
+                            path = os.path.join(dirpath, name + '.flac')
+                            make_flac(path, m, cover_size=cover,
+                                      seekpoints=points)
+                        else:
+                            path = os.path.join(dirpath, name + '.mp3')
+                            make_mp3(path, n, cover_size=cover,
+                                     ver=3 + i % 4 // 2)
+                        paths.append(path)
+    return paths
+
+def _stats(samples, nbytes):
+    samples = sorted(samples)
+    total = sum(samples)
+    return {'files': len(samples),
+            'seconds': total,
+            'files_per_s': len(samples) / total if total else None,
+            'mb_per_s': nbytes / total / 1e6 if total else None,
+            'p50_ms': samples[len(samples) // 2] * 1e3,
+            'p95_ms': samples[int(len(samples) * 0.95)] * 1e3,
+            'max_ms': samples[-1] * 1e3}
+
+def _measure(func, items):
+    # time func on each item, and trace peak of python heap
+    samples = []
+    tracemalloc.start()
+    try:
+        for item in items:
+            start = time.perf_counter()
+            func(item)
+            samples.append(time.perf_counter() - start)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return samples, peak
+
+def bench_parse(paths, use_mmap=False):
+    '''Open and fully parse each file as the scanner does, then read the
+    picture infos only, with use_mmap or not.
+    '''
+    nbytes = sum(open_context(p).size for p in paths)
+    samples, peak = _measure(lambda p: read_record(p, use_mmap), paths)
+    result = _stats(samples, nbytes)
+    samples, peak2 = _measure(lambda p: open_context(p, use_mmap=use_mmap)
+                              .picture_info(), paths)
+    result['peak_bytes'] = peak
+    result['picture_p50_ms'] = _stats(samples, 0)['p50_ms']
+    result['picture_peak_bytes'] = peak2
+    return result
+
+def bench_save(paths, workdir):
+    '''Apply one small edit (in place) and one large edit (full rewrite)
+    to a copy of each file.
+    '''
+    result = {}
+    for name, value in (('inplace', 'short'), ('rewrite', 'x' * 8192)):
+        copies = []
+        for i, path in enumerate(paths):
+            copy = os.path.join(workdir, '%d%s' % (i, os.path.splitext(path)[1]))
+            shutil.copyfile(path, copy)
+            copies.append(copy)
+        nbytes = sum(os.path.getsize(p) for p in copies)
+        edit = lambda p: apply_edits(p, {'TIT2' if p.endswith('.mp3')
+                                         else 'TITLE': value})
+        samples, peak = _measure(edit, copies)
+        result[name] = _stats(samples, nbytes)
+        result[name]['peak_bytes'] = peak
+        for copy in copies:
+            os.remove(copy)
+    return result
+
+def bench_copy(path, workdir, repeat=3):
+    '''Copy the audio payload of a file with copy_file.
+    '''
+    dest = os.path.join(workdir, 'copy.bin')
+    nbytes = os.path.getsize(path)
+    samples, peak = _measure(lambda _: copy_file(dest, path), range(repeat))
+    os.remove(dest)
+    result = _stats(samples, nbytes)
+    result['peak_bytes'] = peak
+    return result
+
+def bench_build(frames=500, text_size=64, cover_size=1 << 20, repeat=5):
+    '''Build an ID3v2 tag and a flac tag with many frames and a cover.
+    '''
+    infos = [build_frame_info('TXXX', 'x' * text_size) for i in range(frames)]
+    apic = build_frame('APIC', b'\x00image/jpeg\x00\x03\x00' + _image(cover_size))
+    comm = blockInfo([('FIELD', 'x' * text_size)] * frames)
+    si = struct.pack('!I', 34) + _streaminfo()
+    pic = struct.pack('!I', 6 << 24 | cover_size) + _image(cover_size)[:cover_size]
+    result = {}
+    for name, func in (('id3', lambda _: create_ID3_tag(*infos, apic)),
+                       ('flac', lambda _: create_Flac_tag(si, comm, pic))):
+        samples, peak = _measure(func, range(repeat))
+        result[name] = _stats(samples, len(func(None)) * repeat)
+        result[name]['peak_bytes'] = peak
+    return result
+
+def run(workdir, quick=False):
+    '''Generate the corpus in workdir and run all benchmarks, return the
+    results as a dict.
+    '''
+    if quick:
+        covers = (1024, 100 * 1024, 1 << 20)
+        count, points = 10, (0, 1000)
+    else:
+        covers = (1024, 100 * 1024, 1 << 20, 10 << 20, 50 << 20)
+        count, points = 20, (0, 50000)
+    # fewer files of the large covers, each size makes 8 times count files
+    counts = {10 << 20: 4, 50 << 20: 2}
+    results = {'python': platform.python_version(),
+               'platform': platform.platform(),
+               'quick': quick,
+               'parse': {}, 'save': {}}
+    corpus = os.path.join(workdir, 'corpus')
+    out = os.path.join(workdir, 'out')
+    os.makedirs(out, exist_ok=True)
+    for cover in covers:
+        n = counts.get(cover, count)
+        paths = make_corpus(os.path.join(corpus, str(cover)), n, (cover,),
+                            (10, 100), points, (10, 500))
+        results['parse'][cover] = {
+            'copy': bench_parse(paths),
+            'mmap': bench_parse(paths, use_mmap=True)}
+        results['save'][cover] = bench_save(paths[:n], out)
+    big = os.path.join(out, 'big.flac')
+    make_flac(big, cover_size=covers[-1],
+              audio_size=(8 << 20) if quick else (64 << 20))
+    results['copy_file'] = bench_copy(big, out)
+    results['build'] = bench_build()
+    try:
+        import resource
+        results['maxrss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    except ImportError:
+        pass
+    return results
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[0])
+    parser.add_argument('--quick', action='store_true',
+                        help = 'smaller corpus for a fast run')
+    parser.add_argument('--out', help = 'write JSON results to file')
+    parser.add_argument('--dir', help = 'directory for the corpus '
+                        '(a temporary one by default)')
+    args = parser.parse_args()
+    workdir = args.dir or tempfile.mkdtemp(prefix='tagbench')
+    try:
+        results = run(workdir, args.quick)
+    finally:
+        if args.dir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+    text = json.dumps(results, indent=1)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
@@ -0,0 +1,130 @@
+from library import ScanRecord
+import os
+import json
+import time
+import sqlite3
+
+__all__ = ['MetadataCache']
+
+class MetadataCache():
+    """Persistent cache of parsed metadata in a sqlite database.
+    Entries are keyed by path and validated by size, mtime_ns and inode of
+    the file, so a hit costs only one stat and the file is never opened.
+    When max_entries is given, least recently used entries are evicted.
+    """
+    _schema = '''CREATE TABLE IF NOT EXISTS entries (
+                     path TEXT NOT NULL,
+                     kind TEXT NOT NULL,
+                     size INTEGER, mtime_ns INTEGER, inode INTEGER,
+                     atime REAL,
+                     value TEXT,
+                     PRIMARY KEY (path, kind));
+                 CREATE INDEX IF NOT EXISTS entries_atime ON entries (atime);'''
+    _batch = 500
+
+    def __init__(self, dbpath, max_entries=None):
+        self.path = dbpath
+        self.max_entries = max_entries
+        self._db = sqlite3.connect(dbpath)
+        self._db.executescript(self._schema)
+        self._dirty = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @staticmethod
+    def _key(st):
+        return st.st_size, st.st_mtime_ns, st.st_ino
+
+    def get(self, path, default=None, kind='record'):
+        '''Return cached value of the file, or default if the file isn't
+        cached or has been changed since.
+        '''
+        return self.get_many((path,), kind).get(path, default)
+
+    def get_many(self, paths, kind='record'):
+        '''Look up many files at once. Return a dict of path and cached
+        value for valid entries only.
+        '''
+        keys = {}
+        for path in paths:
+            try:
+                keys[path] = self._key(os.stat(path))
+            except OSError:
+                pass
+        hits = {}
+        paths = list(keys)
+        for i in range(0, len(paths), self._batch):
+            part = paths[i : i + self._batch]
+            rows = self._db.execute(
+                'SELECT path, size, mtime_ns, inode, value FROM entries '
+                'WHERE kind = ? AND path IN (%s)' % ','.join('?' * len(part)),
+                (kind, *part))
+            for path, size, mtime_ns, inode, value in rows:
+                if keys[path] == (size, mtime_ns, inode):
+                    hits[path] = self._load(kind, value)
+        if hits:
+            now = time.time()
+            self._db.executemany(
+                'UPDATE entries SET atime = ? WHERE kind = ? AND path = ?',
+                ((now, kind, path) for path in hits))
+            self._touch(len(hits))
+        return hits
+
+    def put(self, path, value, kind='record', st=None):
+        '''Store value of the file, keyed by its current stat or given one.
+        The value of default kind is a ScanRecord, or None for a file
+        which isn't audio.
+        '''
+        if st is None:
+            st = os.stat(path)
+        self._db.execute(
+            'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (path, kind, *self._key(st), time.time(), self._dump(kind, value)))
+        self._touch(1)
+
+    def _touch(self, n):
+        self._dirty += n
+        if self._dirty >= self._batch:
+            self.commit()
+
+    def commit(self):
+        self._dirty = 0
+        self.evict()
+        self._db.commit()
+
+    def evict(self):
+        '''Drop least recently used entries beyond max_entries.
+        '''
+        if self.max_entries is None:
+            return
+        count, = self._db.execute('SELECT COUNT(*) FROM entries').fetchone()
+        if count > self.max_entries:
+            self._db.execute(
+                'DELETE FROM entries WHERE rowid IN (SELECT rowid FROM entries '
+                'ORDER BY atime LIMIT ?)', (count - self.max_entries,))
+
+    def close(self):
+        if self._db is not None:
+            self.commit()
+            self._db.close()
+            self._db = None
+
+    def _dump(self, kind, value):
+        if kind == 'record' and value is not None:
+            value = list(value)
+            if value[4] is not None:
+                # md5 signature of STREAMINFO
+                value[4] = value[4][:-1] + [value[4][-1].hex()]
+        return json.dumps(value, ensure_ascii=False)
+
+    def _load(self, kind, value):
+        value = json.loads(value)
+        if kind == 'record' and value is not None:
+            if value[4] is not None:
+                value[4][-1] = bytes.fromhex(value[4][-1])
+            value = ScanRecord(*value)
+        return value
@@ -0,0 +1,125 @@
+'''Export tags of many audio files to JSON Lines, and apply JSON Lines edits.
+
+    python cli.py export [-w N] [--chunk N] [--no-pictures] PATH... > tags.jsonl
+    python cli.py import [-w N] [--chunk N] tags.jsonl > results.jsonl
+
+PATH is an audio file, a directory to walk, or '-' to read paths from
+stdin line by line. Each exported line holds path, format, size, tags and
+pictures of one file as read_tags of library gives; an import line needs
+path and tags, where a null value removes the frame or field. Files are
+processed in a pool and written out as each one completes.
+'''
+from library import *
+import os
+import sys
+import json
+
+__all__ = ['iter_paths', 'export', 'import_edits', 'main']
+
+def iter_paths(args, stdin=None):
+    '''Yield file paths from args of files, directories to walk, or '-'
+    for paths read from stdin.
+    '''
+    for arg in args:
+        if arg == '-':
+            for line in stdin or sys.stdin:
+                line = line.rstrip('\r\n')
+                if line:
+                    yield line
+        elif os.path.isdir(arg):
+            yield from walk(arg)
+        else:
+            yield arg
+
+def export(paths, out, pictures=True, workers=None, executor='thread',
+           chunk=None):
+    '''Write tags of files as JSON Lines to out, a text file object.
+    Return the number of files written and of them failed.
+    '''
+    count = failed = 0
+    for record in export_tags(paths, pictures, workers, executor, chunk):
+        out.write(json.dumps(record, ensure_ascii=False) + '\n')
+        count += 1
+        failed += 'error' in record
+    out.flush()
+    return count, failed
+
+def _jobs(lines):
+    # Parse edit lines into (path, edits), skipping blank lines and the
+    # exported lines of failed files.
+    for n, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            path, tags = record['path'], record.get('tags')
+        except (ValueError, KeyError, TypeError) as e:
+            raise ValueError(f"line {n}: invalid edit: {e}")
+        if tags is not None:
+            yield path, tags
+
+def import_edits(lines, out, workers=None, executor='thread', chunk=None,
+                 atomic=True, fsync=True):
+    '''Apply edits read from JSON Lines and write a JSON line of RetagResult
+    for each file to out. Return the number of files and of them failed.
+    '''
+    count = failed = 0
+    for result in retag(_jobs(lines), workers, executor, atomic, fsync, chunk):
+        out.write(json.dumps(result._asdict(), ensure_ascii=False) + '\n')
+        count += 1
+        failed += result.error is not None
+    out.flush()
+    return count, failed
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest = 'command', required = True)
+    exp = commands.add_parser('export', help = 'write tags as JSON Lines')
+    exp.add_argument('paths', nargs = '+',
+                     help = "files, directories, or '-' for stdin")
+    exp.add_argument('--no-pictures', action = 'store_true',
+                     help = "don't read picture infos")
+    imp = commands.add_parser('import', help = 'apply JSON Lines edits')
+    imp.add_argument('input', nargs = '?', default = '-',
+                     help = "JSON Lines file, or '-' for stdin")
+    imp.add_argument('--no-atomic', action = 'store_true',
+                     help = 'rewrite tags in place when they fit')
+    imp.add_argument('--no-fsync', action = 'store_true',
+                     help = "don't flush files to disk")
+    for command in (exp, imp):
+        command.add_argument('-w', '--workers', type = int,
+                             help = 'size of worker pool')
+        command.add_argument('--chunk', type = int,
+                             help = 'files in flight at once '
+                             '(4 times of workers by default)')
+        command.add_argument('--executor', choices = ('thread', 'process'),
+                             default = 'thread')
+        command.add_argument('-o', '--output', help = 'output file '
+                             '(stdout by default)')
+    args = parser.parse_args(argv)
+    out = sys.stdout if args.output is None else \
+          open(args.output, 'w', encoding = 'utf-8')
+    try:
+        if args.command == 'export':
+            count, failed = export(iter_paths(args.paths),
+                                   out, not args.no_pictures, args.workers,
+                                   args.executor, args.chunk)
+        elif args.input == '-':
+            count, failed = import_edits(sys.stdin, out, args.workers,
+                                         args.executor, args.chunk,
+                                         not args.no_atomic, not args.no_fsync)
+        else:
+            with open(args.input, encoding = 'utf-8') as lines:
+                count, failed = import_edits(lines, out, args.workers,
+                                             args.executor, args.chunk,
+                                             not args.no_atomic,
+                                             not args.no_fsync)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    print(f'{count} files, {failed} failed', file = sys.stderr)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
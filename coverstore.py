@@ -0,0 +1,181 @@
+from util import *
+from mp3 import Mp3Context, build_frame_APIC
+from flac import blockPic
+from library import open_context, _image_ext
+from collections import OrderedDict
+import os
+import hashlib
+import sqlite3
+
+__all__ = ['CoverStore']
+
+class CoverStore():
+    """Content-addressed store of embedded pictures shared by a library.
+    Each unique image is written once under root, named by the digest of
+    its bytes, and every track records references to the images it embeds.
+    Pictures are hashed straight from their byte range in the audio file,
+    and frames or blocks built from the store are memoized, so an album
+    cover is read once however many tracks embed it.
+    """
+    _schema = '''CREATE TABLE IF NOT EXISTS covers (
+                     digest TEXT PRIMARY KEY,
+                     mime TEXT, length INTEGER, name TEXT);
+                 CREATE TABLE IF NOT EXISTS refs (
+                     path TEXT NOT NULL,
+                     n INTEGER NOT NULL,
+                     digest TEXT NOT NULL,
+                     type TEXT, desc TEXT,
+                     PRIMARY KEY (path, n));
+                 CREATE INDEX IF NOT EXISTS refs_digest ON refs (digest);'''
+    _batch = 500
+
+    def __init__(self, root, algorithm='sha256', max_cached=64):
+        self.root = root
+        self.algorithm = algorithm
+        self.max_cached = max_cached
+        os.makedirs(root, exist_ok = True)
+        self._db = sqlite3.connect(os.path.join(root, 'index.db'))
+        self._db.executescript(self._schema)
+        self._dirty = 0
+        self._built = OrderedDict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, path):
+        '''Store every picture embedded in an audio file and reference them
+        from it, replacing its old references. Return a list of digests in
+        picture order.
+        '''
+        ctx = open_context(path)
+        ID = 'APIC' if isinstance(ctx, Mp3Context) else 'PICTURE'
+        digests = []
+        for n in range(ctx.index.count(ID)):
+            info = ctx.picture_info(n)
+            if ID == 'APIC':
+                mime, ptype, desc = info
+            else:
+                ptype, mime, desc = info[:3]
+            digests.append(self._add_picture(ctx, n, mime))
+            self._db.execute('INSERT OR REPLACE INTO refs VALUES (?, ?, ?, ?, ?)',
+                             (path, n, digests[-1], ptype, desc))
+        self._db.execute('DELETE FROM refs WHERE path = ? AND n >= ?',
+                         (path, len(digests)))
+        self._touch(len(digests) + 1)
+        return digests
+
+    def add_many(self, paths):
+        '''Store pictures of many audio files, yielding (path, digests) for
+        each one, or the exception raised instead of digests.
+        '''
+        for path in paths:
+            try:
+                digests = self.add(path)
+            except Exception as e:
+                yield path, e
+            else:
+                yield path, digests
+
+    def _add_picture(self, ctx, n, mime):
+        try:
+            offset, length = ctx.picture_range(n)
+        except ValueError:
+            # compressed or unsynchronised, only decoded data is available
+            data = ctx.frame_APIC(n)[0]
+            digest = hashlib.new(self.algorithm, data).hexdigest()
+            length = len(data)
+        else:
+            data = None
+            digest = ctx.hash_range(offset, length, self.algorithm)
+        row = self._db.execute('SELECT name FROM covers WHERE digest = ?',
+                               (digest,)).fetchone()
+        if row is not None and os.path.exists(os.path.join(self.root, row[0])):
+            tally('covers.hits')
+            return digest
+        tally('covers.stored')
+        dirpath = os.path.join(self.root, digest[:2])
+        os.makedirs(dirpath, exist_ok = True)
+        f, tmppath = temp_file(os.path.join(dirpath, digest))
+        try:
+            with f:
+                if data is None:
+                    ctx.export_picture(f, n)
+                else:
+                    f.write(data)
+            with open(tmppath, 'rb') as f:
+                name = os.path.join(digest[:2], digest + _image_ext(f.read(12)))
+            os.replace(tmppath, os.path.join(self.root, name))
+        except BaseException:
+            os.unlink(tmppath)
+            raise
+        self._db.execute('INSERT OR REPLACE INTO covers VALUES (?, ?, ?, ?)',
+                         (digest, mime, length, name))
+        return digest
+
+    def path_of(self, digest):
+        '''Return path of the stored image of given digest.
+        '''
+        row = self._db.execute('SELECT name FROM covers WHERE digest = ?',
+                               (digest,)).fetchone()
+        if row is None:
+            raise KeyError(f"picture {digest!r} isn't stored")
+        return os.path.join(self.root, row[0])
+
+    def refs(self, path):
+        '''Return a list of (digest, picture type, description) of pictures
+        referenced by an audio file, in picture order.
+        '''
+        return self._db.execute(
+            'SELECT digest, type, desc FROM refs WHERE path = ? ORDER BY n',
+            (path,)).fetchall()
+
+    def tracks(self, digest):
+        '''Return a list of paths of audio files referencing a picture.
+        '''
+        return [row[0] for row in self._db.execute(
+            'SELECT DISTINCT path FROM refs WHERE digest = ? ORDER BY path',
+            (digest,))]
+
+    def frame_APIC(self, digest, use=3):
+        '''Return an APIC frame of the stored picture as build_frame_APIC
+        does. It's built only once for given digest and picture type.
+        '''
+        return self._build(build_frame_APIC, digest, use)
+
+    def block_PICTURE(self, digest, use=3):
+        '''Return a PICTURE block of the stored picture as blockPic does.
+        It's built only once for given digest and picture type.
+        '''
+        return self._build(blockPic, digest, use)
+
+    def _build(self, builder, digest, use):
+        key = builder, digest, use
+        try:
+            self._built.move_to_end(key)
+        except KeyError:
+            path = self.path_of(digest)
+            value = builder(path, use, path.endswith('.png'))
+            self._built[key] = value
+            if len(self._built) > self.max_cached:
+                self._built.popitem(last = False)
+            tally('covers.built')
+            return value
+        return self._built[key]
+
+    def _touch(self, n):
+        self._dirty += n
+        if self._dirty >= self._batch:
+            self.commit()
+
+    def commit(self):
+        self._dirty = 0
+        self._db.commit()
+
+    def close(self):
+        if self._db is not None:
+            self.commit()
+            self._db.close()
+            self._db = None
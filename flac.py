@@ -1,7 +1,63 @@
 from util import *
 import struct
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
 
-__all__ = ['FlacContext', 'blockInfo', 'blockPic', 'create_Flac_tag']
+__all__ = ['FlacContext', 'FlacTagWriter', 'SeekTable', 'CueSheet',
+           'CueTrack', 'blockInfo', 'blockPic', 'picBody', 'picParts', 'blockPadding',
+           'create_Flac_tag', 'iter_blocks']
+
+_BLOCK_HEADER = struct.Struct('!I')
+_LE32 = struct.Struct('<I')
+_CUESHEET_HEADER = struct.Struct('!128sQB258xB')
+_CUESHEET_TRACK = struct.Struct('!QB12sB13xB')
+_CUESHEET_INDEX = struct.Struct('!QB3x')
+
+# sample number of a placeholder seek point
+_PLACEHOLDER = 0xffffffffffffffff
+
+# Decoded CUESHEET block. catalog is the media catalog number, lead_in the
+# number of lead-in samples, tracks a tuple of CueTrack.
+CueSheet = namedtuple('CueSheet', ('catalog', 'lead_in', 'is_cd', 'tracks'))
+
+# One track of cue sheet, offset in samples from the beginning of audio.
+# indexes is a tuple of (offset, number) relative to the track offset.
+CueTrack = namedtuple('CueTrack', ('offset', 'number', 'isrc', 'audio',
+                                   'pre_emphasis', 'indexes'))
+
+class SeekTable():
+    """Seek points of SEEKTABLE block kept in three array columns: sample
+    number, byte offset from the first audio frame and samples of the
+    target frame. Placeholder points are dropped.
+    """
+    __slots__ = ('samples', 'offsets', 'frame_samples')
+
+    def __init__(self, data=b''):
+        n = len(data) // 18
+        values = struct.unpack('!' + 'QQH' * n, data[:n * 18])
+        self.samples = array('Q', values[0::3])
+        self.offsets = array('Q', values[1::3])
+        self.frame_samples = array('H', values[2::3])
+        # placeholders are sorted to the end of table
+        end = bisect_left(self.samples, _PLACEHOLDER)
+        if end < n:
+            del self.samples[end:], self.offsets[end:], self.frame_samples[end:]
+
+    def lookup(self, sample):
+        '''Return sample number and byte offset of the nearest seek point
+        not after given sample, (0, 0) if there's none.
+        '''
+        i = bisect_right(self.samples, sample) - 1
+        if i < 0:
+            return 0, 0
+        return self.samples[i], self.offsets[i]
+
+    def __getitem__(self, i):
+        return self.samples[i], self.offsets[i], self.frame_samples[i]
+
+    def __len__(self):
+        return len(self.samples)
 
 class FlacContext(AudioContext):
     _define = ("STREAMINFO",
@@ -12,11 +68,12 @@ class FlacContext(AudioContext):
                "CUESHEET",
                "PICTURE")
 
-    def __init__(self, filepath):
-        super(FlacContext, self).__init__(filepath)
-        with open(self.path, 'rb') as f:
-            self._buffer = AudioContextBuffer(f.read(self.size))
-        self.blocklist = self._createlabels()
+    def __init__(self, source, use_mmap=False, probe_size=65536, fd=None,
+                 head=None):
+        super(FlacContext, self).__init__(source, use_mmap, probe_size, fd, head)
+        with timed('labels'):
+            self.blocklist = self._createlabels()
+        tally('blocks', len(self.blocklist))
 
     def BLOCK_STREAMINFO(self):
         # <16>  The minimum block size (in samples) used in the stream.
@@ -40,8 +97,23 @@ class FlacContext(AudioContext):
         info.extend(self._buffer.unpack('!16s'))
         return info
 
+    def audio_info(self):
+        '''Return an AudioInfo of the audio frames, computed from total
+        samples in STREAMINFO without reading any frame.
+        '''
+        (min_block, max_block, min_frame, max_frame, rate, channels, bits,
+         total, md5) = self.BLOCK_STREAMINFO()
+        offset, length = self.audio_range()
+        duration = total / rate if total and rate else None
+        bitrate = round(length * 8 / duration) if duration else None
+        return AudioInfo(duration, bitrate, rate, channels + 1, 'streaminfo')
+
     def BLOCK_PADDING(self):
-        pass
+        # <n>   n '0' bits (n must be a multiple of 8)
+        # Return the length of padding block, 0 if no padding.
+        if "PADDING" not in self.blocklist:
+            return 0
+        return self._buffer.labelseek("PADDING")
 
     def BLOCK_APPLICATION(self):
         pass
@@ -64,24 +136,102 @@ class FlacContext(AudioContext):
                    "CONTACT",
                    "ISRC",
                    "ENCODER")
-        self._buffer.labelseek("VORBIS_COMMENT")
+        vendor, comments = self.vorbis_comments()
         comm = dict.fromkeys(_define)
-        vendor = self._buffer.unpack('!%ss' % \
-                                     self._buffer.unpack('<I')[0]\
-                                     )[0].decode()
-        num, = self._buffer.unpack('<I')
-        for i in range(num):
-            length, = self._buffer.unpack('<I')
-            _vec, = self._buffer.unpack('!%ss' % length)
-            vec = _vec.decode().split('=')
-            if comm.setdefault(vec[0], vec[1] + " [Nondefault]") == None:
-                comm[vec[0]] = vec[1]
+        for name, value in comments:
+            if comm.setdefault(name, value + " [Nondefault]") == None:
+                comm[name] = value
         return comm
 
+    def vorbis_comments(self):
+        '''Return vendor string and a list of (field name, value) in order,
+        keeping repeated fields, as they are stored.
+        The block is only decoded on the first access, later calls return
+        the memoized comments until invalidate.
+        '''
+        vendor, comments = self._memo(("VORBIS_COMMENT", 0),
+                                      self._vorbis_comments)
+        return vendor, list(comments)
+
+    def _vorbis_comments(self):
+        self._buffer.labelseek("VORBIS_COMMENT")
+        with timed('decode'):
+            length, = self._buffer.unpack(_LE32)
+            vendor = bytes(self._buffer.read(length)).decode()
+            num, = self._buffer.unpack(_LE32)
+            comments = []
+            for i in range(num):
+                length, = self._buffer.unpack(_LE32)
+                name, sep, value = bytes(self._buffer.read(length)).decode().partition('=')
+                comments.append((name, value))
+        tally('comments_decoded', num)
+        return vendor, tuple(comments)
+
+    def BLOCK_SEEKTABLE(self):
+        # <64>  Sample number of first sample in the target frame,
+        #       or 0xFFFFFFFFFFFFFFFF for a placeholder point.
+        # <64>  Offset (in bytes) from the first byte of the first frame
+        #       header to the first byte of the target frame's header.
+        # <16>  Number of samples in the target frame.
+        # Return a SeekTable object, empty if there's no SEEKTABLE.
+        return self._memo(("SEEKTABLE", 0), self._seektable)
+
+    def _seektable(self):
+        if "SEEKTABLE" not in self.blocklist:
+            return SeekTable()
+        with timed('decode'):
+            table = SeekTable(self._buffer["SEEKTABLE"])
+        tally('seekpoints', len(table))
+        return table
+
+    def seek_offset(self, sample):
+        '''Return sample number and file offset of the audio frame to start
+        decoding from, to reach given sample.
+        '''
+        sample, offset = self.BLOCK_SEEKTABLE().lookup(sample)
+        return sample, self.size + offset
+
     def BLOCK_CUESHEET(self):
-        pass
+        # <128*8> Media catalog number, in printable ASCII.
+        # <64>    The number of lead-in samples.
+        # <1>     1 if the CUESHEET corresponds to a Compact Disc.
+        # <7+258*8> Reserved.
+        # <8>     The number of tracks, then the tracks:
+        #   <64>  Track offset in samples, relative to the beginning of audio.
+        #   <8>   Track number.
+        #   <12*8> Track ISRC.
+        #   <1>   The track type: 0 for audio, 1 for non-audio.
+        #   <1>   The pre-emphasis flag.
+        #   <6+13*8> Reserved.
+        #   <8>   The number of track index points, then the index points:
+        #     <64> Offset in samples, relative to the track offset.
+        #     <8>  The index point number.
+        #     <3*8> Reserved.
+        # Return a CueSheet object, None if there's no CUESHEET.
+        return self._memo(("CUESHEET", 0), self._cuesheet)
 
-    def BLOCK_PICTURE(self):
+    def _cuesheet(self):
+        if "CUESHEET" not in self.blocklist:
+            return None
+        data = self._buffer["CUESHEET"]
+        with timed('decode'):
+            catalog, lead_in, flags, num = _CUESHEET_HEADER.unpack_from(data)
+            pos = _CUESHEET_HEADER.size
+            tracks = []
+            for i in range(num):
+                offset, number, isrc, ttype, n = _CUESHEET_TRACK.unpack_from(data, pos)
+                pos += _CUESHEET_TRACK.size
+                indexes = tuple(_CUESHEET_INDEX.unpack_from(data, pos + 12 * j)
+                                for j in range(n))
+                pos += 12 * n
+                tracks.append(CueTrack(offset, number,
+                                       isrc.rstrip(b'\x00').decode('ascii'),
+                                       not ttype & 0x80, bool(ttype & 0x40),
+                                       indexes))
+        return CueSheet(catalog.rstrip(b'\x00').decode('ascii'), lead_in,
+                        bool(flags & 0x80), tuple(tracks))
+
+    def BLOCK_PICTURE(self, n=0):
         # <32>	The picture type according to the ID3v2 APIC frame
         # <32>	The length of the MIME type string in bytes.
         # <n*8>	The MIME type string, in printable ASCII characters 0x20-0x7e.
@@ -93,80 +243,256 @@ class FlacContext(AudioContext):
         # <32>	For indexed-color pictures (e.g. GIF), the number of colors used, or 0 for non-indexed pictures.
         # <32>	The length of the picture data in bytes.
         # <n*8>	The binary picture data.
-        _define = ("Other",
-                   "32x32 pixels 'file icon' (PNG only)",
-                   "Other file icon",
-                   "Cover (front)",
-                   "Cover (back)",
-                   "Leaflet page",
-                   "Media (e.g. label side of CD)",
-                   "Lead artist/lead performer/soloist",
-                   "Artist/performer",
-                   "Conductor",
-                   "Band/Orchestra",
-                   "Composer",
-                   "Lyricist/text writer",
-                   "Recording Location",
-                   "During recording",
-                   "During performance",
-                   "Movie/video screen capture",
-                   "A bright coloured fish",
-                   "Illustration",
-                   "Band/artist logotype",
-                   "Publisher/Studio logotype")
-        self._buffer.labelseek("PICTURE")
-        info = []
+        # n is the number of PICTURE block if there are several.
+        info = list(self._PICTURE_header(n))
+        info[0] = picture_type(info[0])
+        imageData = self._buffer.read(info.pop())
+        return imageData, info
+
+    def picture_info(self, n=0):
+        '''Return infos of the nth PICTURE block as BLOCK_PICTURE does, but
+        without reading the picture data.
+        '''
+        info = list(self._PICTURE_header(n))
+        info[0] = picture_type(info[0])
+        info.pop()
+        return info
+
+    def _PICTURE_header(self, n=0):
+        # Read PICTURE block till the picture data, leaving the pointer there.
+        self._buffer.labelseek("PICTURE", n=n)
         picType, = self._buffer.unpack('!I')
-        try:
-            picType = _define[picType]
-        except IndexError:
-            raise IndexError("unkonwn picture type: %s" % picType)
-        info.append(picType)
         MIME = self._buffer.unpack('!%ss' % self._buffer.unpack('!I'))[0].decode()
         desc = self._buffer.unpack('!%ss' % self._buffer.unpack('!I'))[0].decode()
-        # also include 4 4-bytes format information
-        info.extend((MIME, desc) + self._buffer.unpack('!4I'))
-        imageData = self._buffer.read(self._buffer.unpack('!I')[0])
-        return imageData, info
+        # also include 4 4-bytes format information and length of data
+        return (picType, MIME, desc) + self._buffer.unpack('!5I')
+
+    def picture(self, n=0):
+        '''Return picture type number, MIME type, description, an ImageInfo
+        and data of the nth PICTURE block, where data is a view of the tag
+        in buffer, not a copy.
+        '''
+        picType, MIME, desc, *info, length = self._PICTURE_header(n)
+        pos = self._buffer.tell()
+        return picType, MIME, desc, ImageInfo(MIME, *info), \
+               self._buffer.getbuffer()[pos : pos + length]
+
+    def picture_range(self, n=0):
+        '''Return offset and length of the nth picture data in the file.
+        '''
+        length = self._PICTURE_header(n)[-1]
+        return self._buffer.tell(), length
 
     def block_copy(self, *blocks, invert=0):
-        raw_block = ()
-        if invert:
-            blocks = [b for b in self.blocklist if b not in blocks]
+        raw_block = []
+        for record in self.index:
+            if (record.id in blocks) == bool(invert):
+                continue
+            self._buffer.seek(record.offset - 4)
+            raw_block.append(self._buffer.read(record.length + 4))
+        return tuple(raw_block)
+
+    def _encode(self, ID, value):
+        # VORBIS_COMMENT also takes a dict or a list of (field name, value)
+        # as blockInfo does, keeping the vendor string.
+        if ID not in self._define:
+            raise ValueError(f"unknown block type: {ID!r}")
+        if ID == "VORBIS_COMMENT" and isinstance(value, (dict, list, tuple)):
+            if "VORBIS_COMMENT" in self.blocklist:
+                vendor = self.vorbis_comments()[0]
+                return blockInfo(value, vendor)[4:]
+            return blockInfo(value)[4:]
+        return super(FlacContext, self)._encode(ID, value)
+
+    def _edited_writer(self):
+        # Return the writer of metadata with pending edits, and the length
+        # of its start which is the same as in file. Untouched blocks are
+        # spliced as they are, and PADDING blocks are dropped to be made
+        # again by the writer.
+        writer = FlacTagWriter()
+        records = []
+        for item in self._pending():
+            if isinstance(item, FrameRecord):
+                if item.id == "PADDING":
+                    continue
+                writer.add(self._splice(item.offset - 4, item.offset + item.length))
+            else:
+                writer.add_block(self._define.index(item[0]), item[1])
+            records.append(item)
+        return writer, records
+
+    def _same(self, writer, records):
+        # Length of the start of new metadata which is the same as in file,
+        # block headers are compared as the last block flag may change.
+        parts = writer.parts()
+        same = 4
+        for i, item in zip(writer._headers, records):
+            if not isinstance(item, FrameRecord) or item.offset - 4 != same or \
+               parts[i + 1] != bytes(self._splice(same, same + 4)):
+                break
+            same = item.offset + item.length
+        return same
+
+    def _slotted(self):
+        # Place changed blocks into the space of removed or replaced ones
+        # and of PADDING, leaving untouched blocks where they are, so only
+        # the changed ones are written. Blocks which don't fit into the
+        # space around their old place go to the space after the last
+        # untouched block. Return a list of (offset, parts) to write, or
+        # None if they don't fit or blocks of a type would change order.
+        pending = [item for item in self._pending()
+                   if not isinstance(item, FrameRecord) or item.id != "PADDING"]
+        placed = []
+        free = []
+
+        def fill(start, end, items):
+            # place items in order, return the ones which don't fit
+            rest = []
+            for k, item in items:
+                size = 4 + sum(map(len, item[1])) \
+                       if isinstance(item[1], list) else 4 + len(item[1])
+                if size > 0xffffff + 4:
+                    return items
+                if end - start == size or end - start >= size + 4:
+                    placed.append((start, k, item))
+                    start += size
+                else:
+                    rest.append((k, item))
+            if start < end:
+                free.append((start, end))
+            return rest
+
+        start = 4
+        moved = []
+        items = []
+        for k, item in enumerate(pending):
+            if isinstance(item, FrameRecord):
+                moved += fill(start, item.offset - 4, items)
+                placed.append((item.offset - 4, k, item))
+                start = item.offset + item.length
+                items = []
+            else:
+                items.append((k, item))
+        if fill(start, self.size, sorted(moved + items)):
+            return None
+        placed.sort()
+        order = {}
+        for offset, k, item in placed:
+            ID = item.id if isinstance(item, FrameRecord) else item[0]
+            if order.get(ID, -1) > k:
+                return None
+            order[ID] = k
+        if not placed or placed[0][0] != 4 or (placed[0][2].id if isinstance(
+           placed[0][2], FrameRecord) else placed[0][2][0]) != "STREAMINFO":
+            return None
+
+        # bodies of PADDING blocks in file are known to be zeros
+        zeros = [(r.offset, r.offset + r.length) for r in self.index
+                 if r.id == "PADDING"]
+        writes = []
+
+        def header(offset, value):
+            value = _BLOCK_HEADER.pack(value)
+            if value != bytes(self._splice(offset, offset + 4)):
+                writes.append((offset, [value]))
+
+        for offset, k, item in placed:
+            if isinstance(item, FrameRecord):
+                last = item.offset + item.length == self.size
+                header(offset, last << 31 | self._define.index(item.id) << 24 |
+                       item.length)
+            else:
+                body = item[1] if isinstance(item[1], list) else [item[1]]
+                length = sum(map(len, body))
+                last = offset + 4 + length == self.size
+                writes.append((offset, [_BLOCK_HEADER.pack(
+                    last << 31 | self._define.index(item[0]) << 24 | length),
+                    *body]))
+        for start, end in free:
+            headers = _paddings(start, end, end == self.size)
+            bounds = [offset for offset, value in headers[1:]] + [end]
+            for (offset, value), stop in zip(headers, bounds):
+                header(offset, value)
+                for s, e in _uncovered(offset + 4, stop, zeros):
+                    writes.append((s, zero_parts(e - s)))
+        writes.sort(key = lambda w: w[0])
+        return writes
+
+    def save(self, *blocks, padding=1024, atomic=False, fsync=False):
+        '''Write a new tag made of metadata blocks back to the flac file,
+        or without blocks given, the one with pending edits by set, replace,
+        add and remove, where only changed blocks are serialized.
+        If the blocks fit into the old tag, the tag is rewritten in place
+        and a PADDING block takes up the rest space, so the audio frames
+        are never touched, nor the blocks kept at the same place. Edited
+        blocks are written into the space of old ones or of PADDING where
+        possible, with untouched blocks left as they are in file.
+        Otherwise the whole file is rewritten with a PADDING block of given
+        size reserved for future edits.
+        With atomic, the file is always rewritten aside and then renamed
+        over the original one; fsync flushes it to disk before the rename.
+        Return True if the tag was rewritten in place.
+        '''
+        if self.path is None:
+            raise ValueError("context isn't backed by a file path")
+        if not blocks and not atomic and self.edited:
+            writes = self._slotted()
+            if writes is not None:
+                # spliced blocks may be views of the file mapped
+                write_ranges(self.path, writes,
+                             copy = self._buffer._view is not None)
+                self.reload()
+                return True
+        records = None
+        if blocks:
+            writer = FlacTagWriter()
+            for b in blocks:
+                writer.add(b)
+        else:
+            writer, records = self._edited_writer()
+        length = len(writer)
+        inplace = False
+        if length == self.size or length + 4 <= self.size:
+            if length != self.size:
+                writer.block_padding = self.size - length - 4
+            if not atomic:
+                same = 0 if records is None else self._same(writer, records)
+                # spliced blocks may be views of the file mapped
+                write_in_place(self.path, 0, *writer.parts(), skip = same,
+                               copy = self._buffer._view is not None)
+                inplace = True
         else:
-            blocks = [b for b in blocks if b in self.blocklist]
-        for b in blocks:
-            length = self._buffer.labelseek(b) + 4
-            self._buffer.seek(-4, 1)
-            raw_block += self._buffer.read(length),
-        return raw_block
-
-    def _tagcheck(self):
-        try:
-            with open(self.path, 'rb') as f:
-                flac, = struct.unpack('!4s', f.read(4))
-        except Exception as e:
-            raise IOError(e)
-        flac = flac.decode()
-        if flac != 'fLaC':
+            writer.block_padding = padding
+        if not inplace:
+            rewrite_file(self.path, self.size, *writer.parts(), fsync = fsync)
+        self.reload()
+        return inplace
+
+    def _tagcheck(self, head):
+        if len(head) < 8:
+            raise IOError("file is too short to hold a tag")
+        if head[:4] != b'fLaC':
             raise TypeError("incorrect file format")
         else:
-            self.tag = flac
+            self.tag = 'fLaC'
 
-    def _getsize(self):
+    def _getsize(self, head):
         size = 4
-        f = open(self.path, 'rb')
         while True:
-            f.seek(size)
-            block_header, = struct.unpack('!I', f.read(4))
+            if size + 4 <= len(head):
+                block_header, = struct.unpack_from('!I', head, size)
+            else:
+                # block header beyond the probed head
+                try:
+                    block_header, = struct.unpack('!I', self._pread(4, size))
+                except struct.error as e:
+                    raise IOError(e)
             flag = block_header >> 31
             size += (block_header & 0xffffff) + 4
             if flag: break
-        f.close()
         return size
-                
+
     def _createlabels(self):
-        table = ()
         length = 0
         self._buffer.seek(4)
         while True:
@@ -177,51 +503,175 @@ class FlacContext(AudioContext):
             try:
                 block_type = self._define[block_type]
                 self._buffer[block_type] = length
-                table += block_type,
             except IndexError:
                 raise IndexError("unknown block type: %s" % block_type)
             self._buffer.seek(length, 1)
             if flag: break
-        return table
+        return self._buffer._index.ids()
+
+def iter_blocks(source, limit=1 << 24, window=65536):
+    '''Walk metadata block headers of source (a path, a descriptor or a
+    bytes-like object) with small reads, and yield a LazyFrame for each
+    block in order, without reading the whole metadata. Bodies are read
+    only when asked for, before the generator is exhausted or closed; see
+    TagSource for limit and window.
+    '''
+    with TagSource(source, limit, window) as src:
+        head = src.peek(0, 8)
+        if len(head) < 8:
+            raise IOError("file is too short to hold a tag")
+        if head[:4] != b'fLaC':
+            raise TypeError("incorrect file format")
+        pos = 4
+        while True:
+            header = src.peek(pos, 4)
+            if len(header) < 4:
+                raise IOError("metadata ends unexpectedly")
+            block_header, = _BLOCK_HEADER.unpack(header)
+            block_type = block_header >> 24 & 0x7f
+            length = block_header & 0xffffff
+            try:
+                block_type = FlacContext._define[block_type]
+            except IndexError:
+                raise IndexError("unknown block type: %s" % block_type)
+            tally('blocks')
+            yield LazyFrame(block_type, pos + 4, length, 0, src)
+            pos += 4 + length
+            if block_header >> 31: break
+
+def _paddings(start, end, last):
+    # Headers of PADDING blocks taking up the space from start to end, as
+    # (offset, header value), split where it's over the 24-bit length.
+    headers = []
+    while end - start - 4 > 0xffffff:
+        length = min(0xffffff, end - start - 8)
+        headers.append((start, 1 << 24 | length))
+        start += length + 4
+    headers.append((start, (0x81 if last else 1) << 24 | end - start - 4))
+    return headers
+
+def _uncovered(start, end, ranges):
+    # Yield parts of the range from start to end not covered by ranges,
+    # which are sorted and disjoint.
+    for s, e in ranges:
+        if e <= start or s >= end:
+            continue
+        if s > start:
+            yield start, s
+        start = max(start, e)
+    if start < end:
+        yield start, end
+
+class FlacTagWriter(TagWriter):
+    """Serializer of flac metadata, the blocks are only joined or written
+    once, and the last-metadata-block flag is set when output.
+    With block_padding, a PADDING block of that size ends the metadata, or
+    several ones taking the same space if it's over 16 MiB.
+    """
+    def __init__(self, block_padding=None):
+        super(FlacTagWriter, self).__init__()
+        self.block_padding = block_padding
+        self._headers = []
+
+    def add(self, block):
+        '''Add a raw metadata block with its header, e.g. from block_copy.
+        '''
+        block = memoryview(block)
+        self.add_block(block[0] & 0x7f, block[4:])
+
+    def add_block(self, block_type, body):
+        '''Add a metadata block of given type number and body, which could
+        be a list of parts such as picBody gives.
+        '''
+        body = body if isinstance(body, list) else [body]
+        length = sum(map(len, body))
+        if length > 0xffffff:
+            raise ValueError("metadata block is too large: %s" % length)
+        self._headers.append(len(self._parts))
+        self._add(_BLOCK_HEADER.pack(block_type << 24 | length), *body)
 
-def blockPic(path, use=3, form=0):
+    def header(self):
+        return b"fLaC"
+
+    def trailer(self):
+        # Space over the 24-bit length is split into more PADDING blocks,
+        # taking the same bytes as one block of block_padding would.
+        if self.block_padding is None:
+            return []
+        if self.block_padding < 0:
+            raise ValueError("invalid padding: %s" % self.block_padding)
+        end = self.block_padding + 4
+        headers = _paddings(0, end, True)
+        bounds = [offset for offset, header in headers[1:]] + [end]
+        parts = []
+        for (offset, header), stop in zip(headers, bounds):
+            parts += _BLOCK_HEADER.pack(header), *zero_parts(stop - offset - 4)
+        return parts
+
+    def parts(self):
+        parts = super(FlacTagWriter, self).parts()
+        if self.block_padding is None and self._headers:
+            # set last metadata block, behind the "fLaC" header
+            i = self._headers[-1] + 1
+            parts[i] = _BLOCK_HEADER.pack(
+                _BLOCK_HEADER.unpack(parts[i])[0] | 0x80000000)
+        return parts
+
+def picBody(path, use=3, desc='', form=0):
+    '''Return body of a PICTURE block as a list of parts, where the picture
+    is a FilePart streamed from path when the tag is written.
+    MIME type, size, color depth and colors are probed from the header of
+    picture; form (1 for PNG, 0 for JPEG) only counts if it's of unknown
+    format, which leaves the numbers zero.
+    '''
+    info = probe_image(path)
+    if info is None:
+        info = ImageInfo('image/png' if form else 'image/jpeg', 0, 0, 0, 0)
+    return picParts(FilePart(path), info, use, desc)
+
+def picParts(data, info, use=3, desc=''):
+    '''Return body of a PICTURE block as a list of parts, holding picture
+    data as it is given, a bytes-like object or FilePart, and the MIME type
+    and numbers of info, an ImageInfo.
+    '''
     if not isinstance(use, int) or use < 0 or use > 20:
-        raise ValueError(f"invalid picture type: {key!r}")
-    with open(path, 'rb') as pic:
-        imageData = pic.read()
-    length = len(imageData)
-    if form:
-        pichead = struct.pack('!2I9s6I', use, 9, b"image/png", *(0,)*5, length)
-        length += 41
-    else:
-        pichead = struct.pack('!2I10s6I', use, 10, b"image/jpeg", *(0,)*5, length)
-        length += 42
-    header = struct.pack('!I', 6 << 24 | length)
-    return header + pichead + imageData
-
-def blockInfo(comm):
-    vendor = b"Lavf58.29.100"
-    length = len(vendor)
-    b = b''
-    b += struct.pack('<I', length)
-    b += struct.pack('!%ss' % length, vendor)
-    b += struct.pack('<I', len(comm))
-    for i in comm:
-        vec = f'{i}={comm[i]}'
-        length = len(vec)
-        b += struct.pack('<I', length)
-        b += struct.pack('!%ss' % length, vec.encode())
-    header = struct.pack('!I', 4 << 24 | len(b))
-    return header + b
+        raise ValueError(f"invalid picture type: {use!r}")
+    mime = info.mime.encode()
+    desc = desc.encode()
+    pichead = b''.join((struct.pack('!2I', use, len(mime)), mime,
+                        struct.pack('!I', len(desc)), desc,
+                        struct.pack('!5I', *info[1:], len(data))))
+    return [pichead, data]
+
+def blockPic(path, use=3, form=0, desc=''):
+    body = picBody(path, use, desc, form)
+    header = _BLOCK_HEADER.pack(6 << 24 | sum(map(len, body)))
+    return b''.join((header, *map(bytes, body)))
+
+def blockInfo(comm, vendor="Lavf58.29.100"):
+    # comm is a dict or a list of (field name, value) pairs
+    if isinstance(comm, dict):
+        comm = comm.items()
+    comm = list(comm)
+    vendor = vendor.encode()
+    parts = [None, _LE32.pack(len(vendor)), vendor, _LE32.pack(len(comm))]
+    length = 8 + len(vendor)
+    for name, value in comm:
+        vec = f'{name}={value}'.encode()
+        parts += _LE32.pack(len(vec)), vec
+        length += 4 + len(vec)
+    parts[0] = _BLOCK_HEADER.pack(4 << 24 | length)
+    return b''.join(parts)
+
+def blockPadding(length):
+    header = _BLOCK_HEADER.pack(1 << 24 | length)
+    return header + bytes(length)
 
 def create_Flac_tag(*blocks):
-    tag = struct.pack('!4s', b"fLaC")
-    for i in range(len(blocks) - 1):
-        tag += blocks[i]
-    # set last metadata block
-    _h = struct.pack('!B', blocks[-1][0] | 0x80)
-    tag += _h + blocks[-1][1:]
-    return tag
+    writer = FlacTagWriter()
+    for b in blocks:
+        writer.add(b)
+    return writer.getvalue()
 
 
 def test(path):
@@ -235,14 +685,55 @@ def test(path):
     bytes_to_file(pic_path, picData)
     print(f'---Export picture to {pic_path!r}...')
     print(f'Picture infos: {picInfo}')
+    import io
+    buffer = io.BytesIO()
+    assert s.export_picture(buffer) == len(picData)
+    assert buffer.getvalue() == bytes(picData)
+    print('---Export picture to io.BytesIO: ok')
+
+def test_roundtrip(path):
+    # Edit the comments of a copy of path, save it in place (once shrunk
+    # and once grown) and then rewritten as a whole, and check that after
+    # parsing it again the edits are there while the other blocks and
+    # audio data are as they were.
+    import os, shutil, tempfile
+    def blocks_of(s):
+        # blocks may be moved, so the last-metadata-block flag is masked
+        return [bytes([raw[0] & 0x7f]) + raw[1:] for raw in
+                s.block_copy('VORBIS_COMMENT', 'PADDING', invert = 1)]
+    def audio(s):
+        offset, length = s.audio_range()
+        with open(s.path, 'rb') as f:
+            f.seek(offset)
+            return f.read(length)
+    with tempfile.TemporaryDirectory() as tmp:
+        copy = shutil.copy(path, os.path.join(tmp, os.path.basename(path)))
+        s = FlacContext(copy)
+        blocks = blocks_of(s)
+        data = audio(s)
+        vendor, comments = s.vorbis_comments() \
+                           if 'VORBIS_COMMENT' in s.blocklist else ('', [])
+        comments = [item for item in comments if item[0].upper() != 'TITLE']
+        for title, atomic in (('', False), ('Round trip ' * 20, False),
+                              ('Round trip', True)):
+            s = FlacContext(copy)
+            s.set('VORBIS_COMMENT', comments + [('TITLE', title)])
+            inplace = s.save(atomic = atomic)
+            s = FlacContext(copy)
+            assert s.vorbis_comments()[1] == comments + [('TITLE', title)]
+            assert blocks_of(s) == blocks
+            assert s.blocklist[0] == 'STREAMINFO'
+            assert audio(s) == data
+            print(f'---Round trip saving {"in place" if inplace else "by rewriting"}: ok')
 
 if __name__ == '__main__':
     import os
     workpath = os.getcwd()
-    path1 = os.path.join(workpath, r"file\test1.flac")
-    path2 = os.path.join(workpath, r"file\test2.flac")
-    newpath = os.path.join(workpath, r"file\test2_new.flac")
+    path1 = os.path.join(workpath, "file", "test1.flac")
+    path2 = os.path.join(workpath, "file", "test2.flac")
+    newpath = os.path.join(workpath, "file", "test2_new.flac")
     test(path1)
+    test_roundtrip(path1)
     
     s = FlacContext(path2)
     block = s.blocklist
@@ -256,7 +747,7 @@ if __name__ == '__main__':
     comm_dict["VERSION"] = "1"
     comm_dict["ALBUM"] = "My Favorite"
     comm = blockInfo(comm_dict)
-    pic = blockPic(os.path.join(workpath, r"file\test2.jpg"))
+    pic = blockPic(os.path.join(workpath, "file", "test2.jpg"))
     tag = create_Flac_tag(info, comm, pic)
     bytes_to_file(newpath, tag)
     copy_file(newpath, path2, s.size, exist_ok = True)
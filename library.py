@@ -0,0 +1,454 @@
+from util import *
+from mp3 import Mp3Context
+from flac import FlacContext
+from collections import namedtuple
+from functools import partial
+from itertools import islice
+from concurrent.futures import (ThreadPoolExecutor, ProcessPoolExecutor,
+                                wait, FIRST_COMPLETED)
+import os
+import time
+
+__all__ = ['open_context', 'export_pictures', 'ScanRecord', 'read_record',
+           'walk', 'scan', 'read_tags', 'export_tags', 'read_fingerprint',
+           'fingerprints', 'duplicates',
+           'RetagResult', 'apply_edits', 'retag']
+
+# One parsed audio file. tags holds text frames (COMM included) for mp3
+# and vorbis comments for flac, streaminfo is only for flac; picture is
+# the picture infos or None. error is the repr of exception if failed.
+ScanRecord = namedtuple('ScanRecord', ('path', 'format', 'size', 'tags',
+                                       'streaminfo', 'picture', 'error'))
+
+# Outcome of retagging one file. inplace tells if only the tag region was
+# rewritten; seconds is the time spent on the file.
+RetagResult = namedtuple('RetagResult', ('path', 'inplace', 'seconds', 'error'))
+
+def open_context(path, **kwargs):
+    '''Create a context object for the audio file according to its
+    magic number, or raise NotAudioError for other files. The file is
+    opened only once, and its head read for the magic number is handed to
+    the context, which reads no more unless the tag is larger than
+    probe_size.
+    '''
+    try:
+        with timed('open'):
+            fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    except OSError as e:
+        raise IOError(e)
+    tally('syscalls.open')
+    try:
+        with timed('read'):
+            head = os.read(fd, kwargs.get('probe_size', 65536))
+        tally('syscalls.read')
+        tally('bytes_read', len(head))
+        if head[:3] == b'ID3':
+            return Mp3Context(path, fd=fd, head=head, **kwargs)
+        elif head[:4] == b'fLaC':
+            return FlacContext(path, fd=fd, head=head, **kwargs)
+        else:
+            raise NotAudioError(f"not a supported audio file: {path!r}")
+    finally:
+        os.close(fd)
+
+def _image_ext(head):
+    if head[:3] == b'\xff\xd8\xff':
+        return '.jpg'
+    elif head[:8] == b'\x89PNG\r\n\x1a\n':
+        return '.png'
+    elif head[:4] == b'GIF8':
+        return '.gif'
+    elif head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return '.webp'
+    return '.bin'
+
+def export_pictures(paths, dirpath, name=None):
+    '''Export embedded pictures of many audio files into dirpath, copying
+    the image bytes from file to file without loading them.
+    name(path) gives the file name without extension, the base name of
+    audio file by default. Yield (path, output path) for each file, with
+    output path None if there is no picture, or the exception raised.
+    '''
+    os.makedirs(dirpath, exist_ok = True)
+    for path in paths:
+        try:
+            ctx = open_context(path)
+            try:
+                offset, length = ctx.picture_range()
+            except KeyError:
+                yield path, None
+                continue
+            with open(path, 'rb') as src:
+                src.seek(offset)
+                ext = _image_ext(src.read(12))
+                if name is None:
+                    stem = os.path.splitext(os.path.basename(path))[0]
+                else:
+                    stem = name(path)
+                outpath = os.path.join(dirpath, stem + ext)
+                with open(outpath, 'wb') as f:
+                    copy_range(src, f, offset, length)
+        except Exception as e:
+            yield path, e
+        else:
+            yield path, outpath
+
+def _executor(executor, workers):
+    # Return the executor to use, and it again if it's created here and
+    # should be shut down after use.
+    if executor == 'thread':
+        pool = ThreadPoolExecutor(workers)
+    elif executor == 'process':
+        pool = ProcessPoolExecutor(workers)
+    else:
+        return executor, None
+    return pool, pool
+
+def read_record(path, use_mmap=False):
+    '''Parse an audio file into a ScanRecord, capturing any error.
+    Return None if it's not a supported audio file.
+    '''
+    try:
+        ctx = open_context(path, use_mmap=use_mmap)
+    except NotAudioError:
+        return None
+    except Exception as e:
+        return ScanRecord(path, None, 0, None, None, None, repr(e))
+    try:
+        if isinstance(ctx, Mp3Context):
+            tags = ctx.frame_Info()
+            if 'COMM' in ctx.frame:
+                tags['COMM'] = ctx.frame_COMM()
+            streaminfo = None
+            has_picture = 'APIC' in ctx.frame
+        else:
+            tags = ctx.BLOCK_VORBIS_COMMENT() \
+                   if 'VORBIS_COMMENT' in ctx.blocklist else {}
+            streaminfo = ctx.BLOCK_STREAMINFO()
+            has_picture = 'PICTURE' in ctx.blocklist
+        picture = ctx.picture_info() if has_picture else None
+    except Exception as e:
+        return ScanRecord(path, ctx.tag, ctx.size, None, None, None, repr(e))
+    return ScanRecord(path, ctx.tag, ctx.size, tags, streaminfo, picture, None)
+
+def walk(root):
+    '''Yield path of every file under the directory tree.
+    '''
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            yield os.path.join(dirpath, name)
+
+def scan(paths, workers=None, executor='thread', pending=None, cache=None):
+    '''Parse many audio files in a thread or process pool, yielding
+    ScanRecord objects in completion order. Files which aren't mp3 or flac
+    by magic number are skipped.
+    paths is a directory to walk, or an iterable of file paths.
+    executor is 'thread', 'process' or an Executor instance; at most
+    pending files (4 times of workers by default) are submitted at once.
+    With a MetadataCache, unchanged files are served from it without
+    being opened, and the others are stored into it.
+    '''
+    for path, record in _pooled(read_record, paths, workers, executor,
+                                pending, cache, 'record'):
+        if record is not None:
+            yield record
+
+def read_tags(path, pictures=True):
+    '''Return tags of an audio file as a dict of path, format, size and
+    tags, which can be dumped to JSON and given back to apply_edits: text
+    frames for mp3, with the text of each COMM and USLT keyed by frame ID,
+    language and description joined by ':', or vorbis comments for flac
+    with values of repeated fields in a list. With pictures, it also holds the
+    infos of every picture. Errors are captured as the repr of exception.
+    Return None if it's not a supported audio file.
+    '''
+    try:
+        ctx = open_context(path)
+    except NotAudioError:
+        return None
+    except Exception as e:
+        return {'path': path, 'error': repr(e)}
+    record = {'path': path, 'format': ctx.tag, 'size': ctx.size}
+    try:
+        if isinstance(ctx, Mp3Context):
+            tags = ctx.frame_Info()
+            for fid, k in _described(ctx):
+                lan, desc, text = ctx.frame_value(fid, k)
+                tags[f'{fid}:{lan}:{desc}'] = text
+            ID = 'APIC'
+        else:
+            tags = {}
+            if 'VORBIS_COMMENT' in ctx.blocklist:
+                for name, value in ctx.vorbis_comments()[1]:
+                    if name not in tags:
+                        tags[name] = value
+                    elif isinstance(tags[name], list):
+                        tags[name].append(value)
+                    else:
+                        tags[name] = [tags[name], value]
+            ID = 'PICTURE'
+        record['tags'] = tags
+        if pictures:
+            record['pictures'] = [ctx.picture_info(n)
+                                  for n in range(ctx.index.count(ID))]
+    except Exception as e:
+        record['error'] = repr(e)
+    return record
+
+def _described(ctx):
+    # (frame ID, number) of COMM and USLT frames in tag order.
+    n = {}
+    for record in ctx.index:
+        if record.id in ('COMM', 'USLT'):
+            n[record.id] = n.get(record.id, -1) + 1
+            yield record.id, n[record.id]
+
+def export_tags(paths, pictures=True, workers=None, executor='thread',
+                pending=None):
+    '''Read tags of many files in a pool as read_tags does, yielding the
+    dicts in completion order. Other arguments are as scan takes.
+    '''
+    func = partial(read_tags, pictures=pictures)
+    for path, record in _pooled(func, paths, workers, executor, pending,
+                                None, None):
+        if record is not None:
+            yield record
+
+def read_fingerprint(path, algorithm='blake2b'):
+    '''Return hex digest of audio data of a file, as fingerprint method of
+    context gives. Return None if it's not a supported audio file.
+    '''
+    try:
+        ctx = open_context(path)
+    except NotAudioError:
+        return None
+    return ctx.fingerprint(algorithm)
+
+def _fingerprint_one(path, algorithm):
+    try:
+        return read_fingerprint(path, algorithm)
+    except Exception as e:
+        return e
+
+def fingerprints(paths, algorithm='blake2b', workers=None, executor='thread',
+                 pending=None, cache=None):
+    '''Hash audio data of many files in a pool, ignoring their tags, and
+    yield (path, hex digest) in completion order, with the exception
+    raised instead of digest if failed. Files which aren't mp3 or flac are
+    skipped. Other arguments are as scan takes; digests are cached as kind
+    'fingerprint:' followed by algorithm.
+    '''
+    func = partial(_fingerprint_one, algorithm=algorithm)
+    for path, digest in _pooled(func, paths, workers, executor, pending,
+                                cache, 'fingerprint:' + algorithm):
+        if digest is not None:
+            yield path, digest
+
+def duplicates(paths, **kwargs):
+    '''Return lists of paths of files holding the same audio data, with
+    kwargs passed to fingerprints. Files failed to hash are left out.
+    '''
+    groups = {}
+    for path, digest in fingerprints(paths, **kwargs):
+        if isinstance(digest, str):
+            groups.setdefault(digest, []).append(path)
+    return [sorted(group) for group in groups.values() if len(group) > 1]
+
+def _pooled(func, paths, workers, executor, pending, cache, kind):
+    # Call func(path) for many files in a pool, yielding (path, result) in
+    # completion order. With a cache, results of unchanged files are served
+    # from it as kind, and new results but exceptions are stored into it.
+    if isinstance(paths, (str, bytes, os.PathLike)):
+        paths = walk(paths)
+    ex, pool = _executor(executor, workers)
+    if pending is None:
+        pending = 4 * (workers or os.cpu_count() or 1)
+    chunk = pending if cache is None else 500
+    running = {}
+
+    def collect():
+        done = wait(running, return_when=FIRST_COMPLETED)[0]
+        for future in done:
+            path = running.pop(future)
+            result = future.result()
+            if cache is not None and not isinstance(result, Exception):
+                try:
+                    cache.put(path, result, kind)
+                except OSError:
+                    pass
+            yield path, result
+
+    try:
+        paths = iter(paths)
+        while True:
+            part = list(islice(paths, chunk))
+            if not part: break
+            if cache is not None:
+                hits = cache.get_many(part, kind)
+                for path in part:
+                    if path in hits:
+                        yield path, hits[path]
+                part = [path for path in part if path not in hits]
+            for path in part:
+                running[ex.submit(func, path)] = path
+                if len(running) >= pending:
+                    yield from collect()
+        while running:
+            yield from collect()
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+        if cache is not None:
+            cache.commit()
+
+def apply_edits(path, edits, **kwargs):
+    '''Apply edits to tag of an audio file and save it, keeping all other
+    frames or comments. kwargs are passed to save method.
+    For mp3, edits maps frame IDs to text of text information frames (a
+    list of text for multiple values), a bytes object as frame body, or
+    None to remove the frames. COMM and USLT keyed as read_tags gives, or
+    by the frame ID alone for English with empty description, only replace
+    or remove the frames of that language and description.
+    Frames already holding the value are left untouched.
+    For flac, edits maps vorbis comment field names to a str, a list of
+    str for repeated fields, or None to remove the field; fields already
+    holding the values are left untouched.
+    Return True if the tag was rewritten in place, or if nothing changed
+    so the file wasn't written at all.
+    '''
+    ctx = open_context(path)
+    if isinstance(ctx, Mp3Context):
+        for key, value in edits.items():
+            fid = key[:4]
+            if fid in ('COMM', 'USLT') and key[4:5] == ':' and key[8:9] == ':':
+                _edit_described(ctx, fid, key[5:8], key[9:], value)
+            elif key in ('COMM', 'USLT') and isinstance(value, str):
+                _edit_described(ctx, key, 'eng', '', value)
+            elif value is None:
+                ctx.remove(key)
+            elif ctx.pending_values(key) != [value]:
+                ctx.set(key, value)
+        return ctx.save(**kwargs) if ctx.edited else True
+    vendor, comments = ctx.vorbis_comments() \
+                       if 'VORBIS_COMMENT' in ctx.blocklist else ('', [])
+    current = {}
+    for name, value in comments:
+        current.setdefault(name.upper(), []).append(value)
+    edits = {name.upper(): value for name, value in edits.items()}
+    edits = {name: value for name, value in edits.items()
+             if current.get(name, []) != ([] if value is None else
+                                          [value] if isinstance(value, str) else
+                                          list(value))}
+    if not edits:
+        return True
+    comments = [c for c in comments if c[0].upper() not in edits]
+    for name, value in edits.items():
+        if value is None:
+            continue
+        elif isinstance(value, str):
+            comments.append((name, value))
+        else:
+            comments.extend((name, v) for v in value)
+    ctx.set('VORBIS_COMMENT', comments)
+    return ctx.save(**kwargs)
+
+def _edit_described(ctx, fid, lan, desc, text):
+    # Replace COMM or USLT frames of given language and description by one
+    # holding text, or remove them if text is None, keeping the others.
+    values = ctx.pending_values(fid)
+    matches = [n for n, value in enumerate(values) if value[:2] == (lan, desc)]
+    if text is not None:
+        if not matches:
+            ctx.add(fid, (lan, desc, text))
+            return
+        n = matches.pop(0)
+        if values[n][2] != text:
+            ctx.replace(fid, (lan, desc, text), n)
+    for n in reversed(matches):
+        ctx.remove(fid, n)
+
+def _retag_one(path, edits, atomic, fsync):
+    start = time.perf_counter()
+    try:
+        inplace = apply_edits(path, edits, atomic = atomic, fsync = fsync)
+    except Exception as e:
+        return RetagResult(path, None, time.perf_counter() - start, repr(e))
+    return RetagResult(path, inplace, time.perf_counter() - start, None)
+
+def retag(jobs, workers=None, executor='thread', atomic=True, fsync=True,
+          pending=None, batch=64):
+    '''Apply many edits concurrently, jobs is an iterable of (path, edits)
+    as apply_edits accepts. Yield a RetagResult for each file in completion
+    order, with errors captured per file.
+    With atomic, every file is rewritten to a temporary file beside it and
+    renamed over, never left truncated. With fsync, the new files are
+    flushed before renamed, and the renames are made durable by one fsync
+    of each directory per batch of finished files, before their results
+    are yielded.
+    '''
+    func = partial(_retag_one, atomic = atomic, fsync = fsync)
+    yield from _batched(func, jobs, workers, executor, fsync, pending, batch)
+
+def _batched(func, jobs, workers, executor, fsync, pending, batch):
+    # Call func(*job) for many jobs in a pool, yielding results in
+    # completion order. Results have path and error fields; with fsync,
+    # directories of the files done without error are flushed once per
+    # batch of results, before they are yielded.
+    ex, pool = _executor(executor, workers)
+    if pending is None:
+        pending = 4 * (workers or os.cpu_count() or 1)
+    running = set()
+    finished = []
+
+    def sync():
+        if fsync:
+            for dirpath in set(os.path.dirname(r.path) for r in finished
+                               if r.error is None):
+                fsync_dir(dirpath)
+        yield from finished
+        finished.clear()
+
+    def collect():
+        nonlocal running
+        done, running = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            finished.append(future.result())
+        if len(finished) >= batch or not fsync:
+            yield from sync()
+
+    try:
+        for job in jobs:
+            running.add(ex.submit(func, *job))
+            if len(running) >= pending:
+                yield from collect()
+        while running:
+            yield from collect()
+        yield from sync()
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+def test_idempotent(path):
+    # Import the exported tags of a copy of path back to it, which should
+    # leave the file untouched, then check that an edit is still saved.
+    import shutil, tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        copy = shutil.copy(path, os.path.join(tmp, os.path.basename(path)))
+        tags = read_tags(copy)['tags']
+        before = os.stat(copy)
+        result, = retag([(copy, tags)])
+        after = os.stat(copy)
+        assert result.error is None, result.error
+        assert (after.st_ino, after.st_mtime_ns) == \
+               (before.st_ino, before.st_mtime_ns)
+        assert read_tags(copy)['tags'] == tags
+        name = next(iter(tags))
+        result, = retag([(copy, {name: 'Round trip'})])
+        assert result.error is None, result.error
+        assert read_tags(copy)['tags'][name] == 'Round trip'
+        print(f'---Idempotent import of {path!r}: ok')
+
+if __name__ == '__main__':
+    workpath = os.getcwd()
+    test_idempotent(os.path.join(workpath, "file", "test.mp3"))
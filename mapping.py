@@ -0,0 +1,216 @@
+from util import *
+from mp3 import Mp3Context, build_APIC_parts
+from flac import FlacContext, picParts
+from library import open_context, _batched
+from collections import namedtuple
+from functools import partial
+import time
+
+__all__ = ['ID3_TO_VORBIS', 'VORBIS_TO_ID3', 'id3_to_vorbis',
+           'vorbis_to_id3', 'SyncResult', 'sync_tags', 'sync_pairs']
+
+# Text information frames and their vorbis comment fields. TRCK and TPOS
+# hold "number/total", split into two fields.
+_MAPPING = (('TIT1', 'GROUPING'),
+            ('TIT2', 'TITLE'),
+            ('TIT3', 'SUBTITLE'),
+            ('TALB', 'ALBUM'),
+            ('TPE1', 'ARTIST'),
+            ('TPE2', 'ALBUMARTIST'),
+            ('TPE3', 'CONDUCTOR'),
+            ('TPE4', 'REMIXER'),
+            ('TCOM', 'COMPOSER'),
+            ('TEXT', 'LYRICIST'),
+            ('TOPE', 'ORIGINALARTIST'),
+            ('TCON', 'GENRE'),
+            ('TRCK', 'TRACKNUMBER'),
+            ('TPOS', 'DISCNUMBER'),
+            ('TDRC', 'DATE'),
+            ('TDOR', 'ORIGINALDATE'),
+            ('TCOP', 'COPYRIGHT'),
+            ('TPUB', 'ORGANIZATION'),
+            ('TSRC', 'ISRC'),
+            ('TSSE', 'ENCODER'),
+            ('TENC', 'ENCODEDBY'),
+            ('TBPM', 'BPM'),
+            ('TKEY', 'KEY'),
+            ('TLAN', 'LANGUAGE'),
+            ('TMOO', 'MOOD'),
+            ('TMED', 'MEDIA'),
+            ('TCMP', 'COMPILATION'),
+            ('TSOA', 'ALBUMSORT'),
+            ('TSOP', 'ARTISTSORT'),
+            ('TSOT', 'TITLESORT'),
+            ('TSO2', 'ALBUMARTISTSORT'),
+            ('TSOC', 'COMPOSERSORT'),
+            ('COMM', 'COMMENT'),
+            ('USLT', 'LYRICS'))
+
+# Frame IDs to vorbis comment fields and back, TYER of ID3v2.3 read as
+# DATE and some common field names read as the ones above.
+ID3_TO_VORBIS = dict(_MAPPING, TYER = 'DATE')
+VORBIS_TO_ID3 = {field: fid for fid, field in _MAPPING}
+_ALIASES = {'DESCRIPTION': 'COMMENT',
+            'YEAR': 'DATE',
+            'ALBUM ARTIST': 'ALBUMARTIST',
+            'TOTALTRACKS': 'TRACKTOTAL',
+            'TOTALDISCS': 'DISCTOTAL',
+            'UNSYNCEDLYRICS': 'LYRICS'}
+_TOTALS = {'TRACKNUMBER': 'TRACKTOTAL', 'DISCNUMBER': 'DISCTOTAL'}
+
+# Result of syncing one pair, path is the destination file.
+SyncResult = namedtuple('SyncResult', ('source', 'path', 'inplace',
+                                       'seconds', 'error'))
+
+def id3_to_vorbis(ctx):
+    '''Return a list of (field name, value) of vorbis comments mapped from
+    the text frames, COMM, USLT and TXXX of an Mp3Context, in tag order.
+    TXXX becomes a field named by its description, and other frames
+    without a field are left out.
+    '''
+    comments = []
+    date = {}
+    n = {}
+    for record in ctx.index:
+        fid = record.id
+        k = n[fid] = n.get(fid, -1) + 1
+        if fid == 'TXXX':
+            desc, value = ctx.frame_value(fid, k)
+            if desc and '=' not in desc:
+                comments.append((desc.upper(), value))
+            continue
+        elif fid in ('TYER', 'TDAT'):
+            date[fid] = ctx.frame_value(fid, k)
+            continue
+        field = ID3_TO_VORBIS.get(fid)
+        if field is None:
+            continue
+        values = ctx.frame_value(fid, k)
+        if fid in ('COMM', 'USLT'):
+            values = values[2]
+        if not isinstance(values, list):
+            values = [values]
+        for value in values:
+            if field in _TOTALS and '/' in value:
+                value, total = value.split('/', 1)
+                comments += (field, value), (_TOTALS[field], total)
+            else:
+                comments.append((field, value))
+    if 'TYER' in date and 'TDRC' not in ctx.index:
+        # ID3v2.3 keeps the year and DDMM apart
+        value = date['TYER']
+        ddmm = date.get('TDAT', '')
+        if len(ddmm) == 4 and ddmm.isdigit():
+            value = f'{value}-{ddmm[2:]}-{ddmm[:2]}'
+        comments.append(('DATE', value))
+    return comments
+
+def vorbis_to_id3(comments, ver=3):
+    '''Return a list of (frame ID, value) for the set method of Mp3Context
+    from (field name, value) of vorbis comments, one item for each frame.
+    Repeated fields make a text frame of multiple values (joined by '/'
+    when set into an ID3v2.3 tag), TRACKTOTAL and DISCTOTAL are joined
+    into TRCK and TPOS, and fields without a frame ID become TXXX frames.
+    DATE is written as TYER and TDAT for ID3v2.3.
+    '''
+    fields = {}
+    for name, value in comments:
+        name = name.upper()
+        fields.setdefault(_ALIASES.get(name, name), []).append(value)
+    for field, total in _TOTALS.items():
+        if total in fields:
+            if field in fields and '/' not in fields[field][0]:
+                fields[field][0] += '/' + fields[total][0]
+            del fields[total]
+    frames = []
+    for field, values in fields.items():
+        fid = VORBIS_TO_ID3.get(field)
+        if fid is None:
+            for value in values:
+                body = b'\x01' + b'\x00\x00'.join((field.encode('utf16'),
+                                                   value.encode('utf16')))
+                frames.append(('TXXX', body))
+        elif fid in ('COMM', 'USLT'):
+            frames += ((fid, value) for value in values)
+        elif fid == 'TDRC' and ver < 4:
+            date = values[0]
+            frames.append(('TYER', date[:4]))
+            if len(date) >= 10 and date[4] == date[7] == '-':
+                frames.append(('TDAT', date[8:10] + date[5:7]))
+        else:
+            frames.append((fid, values[0] if len(values) == 1 else values))
+    return frames
+
+def _sync_mp3(src, dst, pictures):
+    # FLAC to mp3: text frames, COMM, USLT and TXXX of dst are replaced,
+    # other frames are kept.
+    vendor, comments = src.vorbis_comments() \
+                       if 'VORBIS_COMMENT' in src.blocklist else ('', [])
+    # The first frame of each ID is set at the place of the old one.
+    ver = 3 if dst.unsync else dst.ver[0]
+    done = set()
+    for fid, value in vorbis_to_id3(comments, ver):
+        if fid in done:
+            dst.add(fid, value)
+        else:
+            dst.set(fid, value)
+            done.add(fid)
+    for fid in set(dst.index.ids()):
+        if fid not in done and (fid[0] == 'T' or fid in ('COMM', 'USLT') or
+                                pictures and fid == 'APIC'):
+            dst.remove(fid)
+    if pictures:
+        for n in range(src.index.count('PICTURE')):
+            use, mime, desc, info, data = src.picture(n)
+            dst.add('APIC', build_APIC_parts(data, mime, use, desc))
+
+def _sync_flac(src, dst, pictures):
+    # mp3 to FLAC: vorbis comments of dst are replaced, keeping the vendor.
+    dst.set('VORBIS_COMMENT', id3_to_vorbis(src))
+    if pictures:
+        dst.remove('PICTURE')
+        for n in range(src.index.count('APIC')):
+            use, mime, desc, data = src.picture(n)
+            info = probe_image(data)
+            if info is None:
+                info = ImageInfo(mime, 0, 0, 0, 0)
+            dst.add('PICTURE', picParts(data, info._replace(mime = mime),
+                                        use, desc))
+
+def sync_tags(source, path, pictures=True, **kwargs):
+    '''Copy tags of an mp3 file to its flac counterpart or the reverse,
+    replacing the tags of path in one save, with kwargs passed to save
+    method. Frames are mapped to vorbis comments by the tables, and
+    pictures are copied with their bytes as they are in source, without
+    decoding the images; with pictures false, those of path are kept.
+    Return True if the tag was rewritten in place.
+    '''
+    src = open_context(source)
+    dst = open_context(path)
+    if isinstance(src, Mp3Context) and isinstance(dst, FlacContext):
+        _sync_flac(src, dst, pictures)
+    elif isinstance(src, FlacContext) and isinstance(dst, Mp3Context):
+        _sync_mp3(src, dst, pictures)
+    else:
+        raise TypeError(f"{source} and {path} aren't an mp3 and flac pair")
+    return dst.save(**kwargs)
+
+def _sync_one(source, path, pictures, atomic, fsync):
+    start = time.perf_counter()
+    try:
+        inplace = sync_tags(source, path, pictures,
+                            atomic = atomic, fsync = fsync)
+    except Exception as e:
+        return SyncResult(source, path, None, time.perf_counter() - start,
+                          repr(e))
+    return SyncResult(source, path, inplace, time.perf_counter() - start, None)
+
+def sync_pairs(pairs, pictures=True, workers=None, executor='thread',
+               atomic=True, fsync=True, pending=None, batch=64):
+    '''Sync tags of many (source, path) pairs concurrently as sync_tags
+    does, yielding a SyncResult for each pair in completion order, with
+    errors captured per pair. Other arguments are as retag takes.
+    '''
+    func = partial(_sync_one, pictures = pictures, atomic = atomic,
+                   fsync = fsync)
+    yield from _batched(func, pairs, workers, executor, fsync, pending, batch)
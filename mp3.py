@@ -1,8 +1,17 @@
 from util import *
 import struct
+import zlib
 
-__all__ = ['Mp3Context', 'build_frame_info', 'build_frame_infos',
-           'build_frame_APIC', 'create_ID3_tag']
+__all__ = ['Mp3Context', 'ENCODINGS', 'decode_frame', 'ID3TagWriter',
+           'build_frame', 'build_frame_info', 'build_frame_infos',
+           'build_frame_APIC', 'build_APIC_body', 'build_APIC_parts',
+           'create_ID3_tag', 'iter_frames']
+
+# Text encodings of ID3v2 frames, indexed by the encoding byte
+ENCODINGS = ('latin-1', 'utf-16', 'utf-16-be', 'utf-8')
+
+_TAG_HEADER = struct.Struct('!3s3BI')
+_FRAME_HEADER = struct.Struct('!4sIH')
 
 def ID3_sync_safe_to_int(sync_safe_integer):
     byte0 = sync_safe_integer >> 24 & 0xff
@@ -18,50 +27,301 @@ def int_to_ID3_sync_safe(integer):
     byte3 = integer & 0x7f
     return byte0 << 24 | byte1 << 16 | byte2 << 8 | byte3
 
+# Bitrates in kbps of MPEG audio by (MPEG-2/2.5, layer - 1) and index
+_BITRATES = (((0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+              (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+              (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320)),
+             ((0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+              (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+              (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160)))
+# Sample rates of MPEG audio by version ID (2.5, reserved, 2, 1) and index
+_SAMPLE_RATES = ((11025, 12000, 8000), None,
+                 (22050, 24000, 16000), (44100, 48000, 32000))
+_BE32 = struct.Struct('!I')
+# Frames of this size at least are kept before others when edited
+_LARGE_FRAME = 4096
+_VBRI = struct.Struct('!4s3H2I')
+
+def _mpeg_frame(header):
+    # Parse MPEG audio frame header given as an int, return a tuple of
+    # frame length, samples, sample rate, channels and the length of side
+    # information, or None if it's not a valid (or free format) header.
+    if header >> 21 != 0x7ff:
+        return None
+    version = header >> 19 & 3
+    layer = 4 - (header >> 17 & 3)
+    index = header >> 12 & 15
+    rate_index = header >> 10 & 3
+    if version == 1 or layer == 4 or index in (0, 15) or rate_index == 3:
+        return None
+    lsf = version != 3
+    bitrate = _BITRATES[lsf][layer - 1][index] * 1000
+    rate = _SAMPLE_RATES[version][rate_index]
+    padding = header >> 9 & 1
+    mono = header >> 6 & 3 == 3
+    if layer == 1:
+        samples = 384
+        length = (12 * bitrate // rate + padding) * 4
+    else:
+        samples = 576 if lsf and layer == 3 else 1152
+        length = samples // 8 * bitrate // rate + padding
+    side = (9 if mono else 17) if lsf else (17 if mono else 32)
+    return length, samples, rate, 1 if mono else 2, side
+
+def _sync(data, pos=0):
+    # Find the first valid frame header from pos, return its position and
+    # the parsed header, or (-1, None).
+    while True:
+        pos = data.find(b'\xff', pos)
+        if pos < 0 or pos + 4 > len(data):
+            return -1, None
+        frame = _mpeg_frame(_BE32.unpack_from(data, pos)[0])
+        if frame is not None:
+            return pos, frame
+        pos += 1
+
+def _deunsync(data):
+    # Undo unsynchronisation, which inserts $00 after every $FF.
+    return bytes(data).replace(b'\xff\x00', b'\xff')
+
+def _inflate(data, size=None, chunk=65536):
+    # Inflate a compressed frame body piece by piece, size is the length
+    # given by data length indicator if any.
+    d = zlib.decompressobj()
+    view = memoryview(data)
+    parts = []
+    try:
+        for i in range(0, len(view), chunk):
+            parts.append(d.decompress(view[i : i + chunk]))
+            if d.eof: break
+        parts.append(d.flush())
+    except zlib.error as e:
+        raise ValueError(f"corrupt compressed frame: {e}")
+    data = b''.join(parts)
+    tally('bytes_inflated', len(data))
+    if size is not None and len(data) != size:
+        raise ValueError(f"compressed frame inflates to {len(data)} bytes, "
+                         f"{size} expected")
+    return data
+
+def _terminator(encoding):
+    return b'\x00\x00' if encoding in (1, 2) else b'\x00'
+
+def _split_text(data, start, encoding):
+    # Find the end of string from start, return it and the position after
+    # terminator. A 2 bytes terminator only counts at even offsets.
+    end = _terminator(encoding)
+    n = len(end)
+    pos = start
+    while True:
+        i = data.find(end, pos)
+        if i < 0:
+            return len(data), len(data)
+        if (i - start) % n == 0:
+            return i, i + n
+        pos = i + 1
+
+def _decode_text(data, start, encoding, encodings):
+    # Decode one terminated string from start, return it and the position
+    # after terminator.
+    try:
+        codec = encodings[encoding]
+    except IndexError:
+        raise ValueError(f"unknown text encoding: {encoding}")
+    end, pos = _split_text(data, start, encoding)
+    return str(data[start : end], codec), pos
+
+def decode_frame(fid, data, encodings=ENCODINGS):
+    '''Decode body of a frame, data is a bytes object.
+    Text information frames give a str, or a list for multiple values;
+    TXXX gives (description, value), WXXX gives (description, url),
+    COMM and USLT give (language, description, text) and other URL link
+    frames give the url. Frames of other IDs are returned as they are.
+    encodings could be replaced, e.g. to decode legacy tags which use
+    encoding 0 for a local code page.
+    '''
+    if fid == 'TXXX':
+        desc, pos = _decode_text(data, 1, data[0], encodings)
+        value, pos = _decode_text(data, pos, data[0], encodings)
+        return desc, value
+    elif fid[0] == 'T':
+        if not data:
+            return ''
+        values = []
+        pos = 1
+        while pos < len(data):
+            value, pos = _decode_text(data, pos, data[0], encodings)
+            values.append(value)
+        if len(values) == 1:
+            return values[0]
+        return values or ''
+    elif fid == 'WXXX':
+        desc, pos = _decode_text(data, 1, data[0], encodings)
+        return desc, _decode_text(data, pos, 0, ENCODINGS)[0]
+    elif fid[0] == 'W':
+        return _decode_text(data, 0, 0, ENCODINGS)[0]
+    elif fid in ('COMM', 'USLT'):
+        lan = str(data[1:4], 'latin-1')
+        desc, pos = _decode_text(data, 4, data[0], encodings)
+        text, pos = _decode_text(data, pos, data[0], encodings)
+        return lan, desc, text
+    return data
+
 class Mp3Context(AudioContext):
-    def __init__(self, filepath):
-        super(Mp3Context, self).__init__(filepath)
-        with open(self.path, 'rb') as f:
-            self._buffer = AudioContextBuffer(f.read(self.size))
-        id3, ver, revision, flags, length = self._buffer.unpack('!3s3BI')
+    encodings = ENCODINGS
+
+    def __init__(self, source, use_mmap=False, probe_size=65536, fd=None,
+                 head=None):
+        super(Mp3Context, self).__init__(source, use_mmap, probe_size, fd, head)
+        id3, ver, revision, flags, length = self._buffer.unpack(_TAG_HEADER)
         self.ver = (ver, revision)
-        self.frame, self.frame_flag = self._createlabels()
-
-    def _tagcheck(self):
-        try:
-            with open(self.path, 'rb') as f:
-                id3, = struct.unpack('!3s', f.read(3))
-        except Exception as e:
-            raise IOError(e)
-        id3 = id3.decode()
-        if id3 != 'ID3':
+        self.flags = flags
+        # Unsynchronisation of ID3v2.3 covers the whole tag and frame sizes
+        # count the bytes after undoing it, while ID3v2.4 does it frame by
+        # frame. Offsets of an undone tag no longer match the file.
+        self.unsync = bool(flags & 0x80)
+        if self.unsync and ver < 4:
+            self._buffer = AudioContextBuffer(_deunsync(self._buffer.getvalue()))
+        with timed('labels'):
+            self.frame, self.frame_flag = self._createlabels()
+        tally('frames', len(self.frame))
+
+    def _tagcheck(self, head):
+        if len(head) < 10:
+            raise IOError("file is too short to hold a tag")
+        if head[:3] != b'ID3':
             raise TypeError("incorrect file format")
         else:
-            self.tag = id3
+            self.tag = 'ID3'
 
-    def _getsize(self):
-        with open(self.path, 'rb') as f:
-            f.seek(6)
-            size, = struct.unpack('!I', f.read(4))
-        size = ID3_sync_safe_to_int(size)
+    def _getsize(self, head):
+        # The size in header excludes the 10-bytes header itself
+        # and the footer (ID3v2.4 only) if present.
+        flags, size = struct.unpack_from('!BI', head, 5)
+        size = ID3_sync_safe_to_int(size) + 10
+        if flags & 0x10:
+            size += 10
         return size
 
     def _createlabels(self):
-        table = (); flag = ()
-        size = self.size - 10
-        self._buffer.seek(10)
-        while True:
-            fid, length, flags = self._buffer.unpack('!4sIH')
-            fid = fid.decode()
-            if length == 0: break
+        end = min(self.size, self._buffer.seek(0, 2))
+        pos = 10
+        if self.flags & 0x40:
+            # extended header, its size excludes itself in v2.3
+            self._buffer.seek(pos)
+            size, = self._buffer.unpack(_BE32)
+            pos += ID3_sync_safe_to_int(size) if self.ver[0] == 4 else size + 4
+        self._buffer.seek(pos)
+        while pos + 10 <= end:
+            fid, length, flags = self._buffer.unpack(_FRAME_HEADER)
+            # reach padding
+            if length == 0 or fid[0] == 0: break
             if self.ver[0] == 4:
                 length = ID3_sync_safe_to_int(length)
-            self._buffer[fid] = length
+            if pos + 10 + length > end: break
+            self._buffer.setlabel(fid.decode('latin-1'), length, flags)
             self._buffer.seek(length, 1)
-            table += fid,; flag += flags,
-            size -= length + 10
-            if size <= 0: break
-        return table, flag
+            pos = self._buffer.tell()
+        self.padding = max(0, end - pos)
+        # Bytes left after the frames should be zero padding, otherwise the
+        # tag isn't fully parsed and can't be saved with edits.
+        self.intact = not bytes(self._splice(pos, max(pos, end))).strip(b'\x00')
+        index = self._buffer._index
+        return index.ids(), tuple(record.flags for record in index)
+
+    def audio_info(self, estimate=False):
+        '''Return an AudioInfo of the audio data after tag. It's read from
+        the Xing/Info or VBRI header in the first frame, and only if there's
+        none, from walking through all frame headers, or with estimate, from
+        frames sampled over the file.
+        '''
+        return self._memo(("AUDIO", bool(estimate)), self._audio_info, estimate)
+
+    def _audio_info(self, estimate, chunk=1 << 20, windows=16, window=65536):
+        with self._opened(), timed('audio'):
+            start, length = self._audio_range()
+            end = start + length
+            head = bytes(self._pread(min(length, 65536), start))
+            pos, frame = _sync(head)
+            if frame is None:
+                return AudioInfo(None, None, None, None, 'scan')
+            flength, samples, rate, channels, side = frame
+            info = self._vbr_header(head, pos, frame)
+            if info is not None:
+                frames, nbytes, source = info
+                duration = frames * samples / rate
+                bitrate = round((nbytes or end - start - pos) * 8 / duration) \
+                          if duration else None
+                return AudioInfo(duration, bitrate, rate, channels, source)
+            start += pos
+            if estimate and end - start > windows * window * 4:
+                # frames in windows evenly spread over the audio
+                step = (end - start) // windows
+                samples = nbytes = 0
+                for i in range(windows):
+                    n, size = self._walk_frames(start + i * step,
+                                                start + i * step + window,
+                                                rate, window)
+                    samples += n; nbytes += size
+                samples = samples * (end - start) // nbytes if nbytes else 0
+                source = 'estimate'
+            else:
+                samples, nbytes = self._walk_frames(start, end, rate, chunk)
+                source = 'scan'
+        duration = samples / rate
+        bitrate = round((end - start) * 8 / duration) if duration else None
+        return AudioInfo(duration, bitrate, rate, channels, source)
+
+    def _vbr_header(self, head, pos, frame):
+        # Look for Xing/Info or VBRI header in the first frame at pos,
+        # return frames, bytes (None if absent) and header type.
+        side = frame[4]
+        x = pos + 4 + side
+        if head[x : x + 4] in (b'Xing', b'Info') and x + 8 <= len(head):
+            flags, = _BE32.unpack_from(head, x + 4)
+            x += 8
+            frames = nbytes = None
+            if flags & 1 and x + 4 <= len(head):
+                frames, = _BE32.unpack_from(head, x)
+                x += 4
+            if flags & 2 and x + 4 <= len(head):
+                nbytes, = _BE32.unpack_from(head, x)
+            if frames:
+                return frames, nbytes, str(head[pos + 4 + side :
+                                                pos + 8 + side], 'ascii').lower()
+        x = pos + 36
+        if head[x : x + 4] == b'VBRI' and x + _VBRI.size <= len(head):
+            vbri, version, delay, quality, nbytes, frames = _VBRI.unpack_from(head, x)
+            if frames:
+                return frames, nbytes, 'vbri'
+        return None
+
+    def _walk_frames(self, pos, end, rate, chunk):
+        # Walk through frame headers from pos to end in chunks, resyncing
+        # by searching $FF when a header is broken, and return the number
+        # of samples and bytes of frames found.
+        samples = nbytes = 0
+        base = pos
+        data = b''
+        while pos + 4 <= end:
+            if pos + 4 > base + len(data):
+                base = pos
+                data = bytes(self._pread(min(chunk, end - pos), pos))
+                if len(data) < 4: break
+            i, frame = _sync(data, pos - base)
+            if frame is None:
+                # keep the last bytes, which may begin a header
+                pos = max(pos + 1, base + len(data) - 3)
+                continue
+            if i != pos - base or frame[2] != rate:
+                # junk, or a false sync of another sample rate
+                pos = base + i + (frame[2] != rate)
+                continue
+            samples += frame[1]
+            nbytes += frame[0]
+            pos += frame[0]
+        tally('bytes_scanned', nbytes)
+        return samples, nbytes
 
     def frame_Info(self, frame_ID=None):
         # <Header for 'Text information frame', ID: "T000" - "TZZZ",
@@ -71,20 +331,15 @@ class Mp3Context(AudioContext):
         names =  []
         if frame_ID == None:
             for i in self.frame:
-                if i[0] == 'T':
+                if i[0] == 'T' and i != 'TXXX':
                     names.append(i)
-        elif frame_ID.find('T') != 0:
+        elif frame_ID.find('T') != 0 or frame_ID == 'TXXX':
             raise ValueError(f"{frame_ID} isn't one ID of text information frame")
         else:
             names.append(frame_ID)
         info = {}
         for i in names:
-            length = self._buffer.labelseek(i)
-            encoding, content = self._buffer.unpack('!B%ss' % (length - 1))
-            if encoding:
-                info[i] = content.decode('utf16')
-            else:
-                info[i] = content.decode('gbk')
+            info[i] = self.frame_value(i)
         if frame_ID == None:
             return info
         else:
@@ -96,65 +351,364 @@ class Mp3Context(AudioContext):
         # Language                $xx xx xx
         # Short content descrip.  <text string according to encoding> $00 (00)
         # The actual text         <full text string according to encoding>
-        end = self._buffer.labelseek("COMM", 0)
-        encoding, lan = self._buffer.unpack('!B3s')
-        _desc = self._buffer.read2()
-        content = self._buffer.read(end - self._buffer.tell())
-        if encoding:
-            return content.decode('utf16')
+        return self.frame_value('COMM')[2]
+
+    def frame_value(self, frame_ID, n=0):
+        '''Return the nth frame of given ID decoded by decode_frame.
+        A frame is only decoded (and inflated if compressed) on the first
+        access, later calls return the memoized value until invalidate.
+        '''
+        return self._memo((frame_ID, n), self._decode, frame_ID, n)
+
+    def _decode(self, frame_ID, n):
+        body = self.frame_body(frame_ID, n)
+        with timed('decode'):
+            value = decode_frame(frame_ID, bytes(body), self.encodings)
+        tally('frames_decoded')
+        return value
+
+    def frame_body(self, frame_ID, n=0):
+        '''Return body of the nth frame of given ID, with grouping byte and
+        data length indicator stripped, unsynchronisation undone and
+        compression inflated as frame flags tell.
+        Encrypted frames are returned as they are stored.
+        '''
+        record = self._buffer.label(frame_ID, n)
+        data = self._buffer[frame_ID, n]
+        if not self._transformed(record):
+            return data
+        flags = record.flags
+        pos = 0
+        size = None
+        if self.ver[0] == 4:
+            # grouping identity, encryption method and data length indicator
+            # are added in this order
+            if flags & 0x0040: pos += 1
+            if flags & 0x0004: return data
+            if flags & 0x0001:
+                size, = struct.unpack_from('!I', data, pos)
+                size = ID3_sync_safe_to_int(size)
+                pos += 4
+            data = data[pos:]
+            if flags & 0x0002 or self.unsync:
+                data = _deunsync(data)
         else:
-            return content.decode('gbk')
+            # decompressed size, encryption method and group identifier
+            if flags & 0x0080:
+                size, = struct.unpack_from('!I', data, pos)
+                pos += 4
+            if flags & 0x0040: return data
+            if flags & 0x0020: pos += 1
+            data = data[pos:]
+        if flags & (0x0008 if self.ver[0] == 4 else 0x0080):
+            data = _inflate(data, size)
+        return data
 
-    def frame_APIC(self):
+    def _transformed(self, record):
+        # If body of the frame isn't stored as it is, following v2.4 or v2.3
+        # format flags.
+        if self.ver[0] == 4:
+            return bool(record.flags & 0x004f) or self.unsync
+        return bool(record.flags & 0x00e0)
+
+    def frames(self):
+        '''Decode all frames in one pass, return a list of frame ID and
+        value as decode_frame gives, in tag order with repeated IDs kept.
+        APIC gives the infos of frame_APIC with the picture data appended.
+        '''
+        frames = []
+        n = {}
+        for i in self.frame:
+            k = n[i] = n.get(i, -1) + 1
+            if i == 'APIC':
+                imageData, info = self.frame_APIC(k)
+                frames.append((i, (*info, imageData)))
+            else:
+                frames.append((i, self.frame_value(i, k)))
+        return frames
+
+    def pending_values(self, frame_ID):
+        '''Return values of frames of given ID in order as frame_value
+        decodes them, with pending edits applied.
+        '''
+        records = self.index.getall(frame_ID)
+        values = []
+        for item in self._pending():
+            if isinstance(item, FrameRecord):
+                if item.id == frame_ID:
+                    n = next(i for i, r in enumerate(records) if r is item)
+                    values.append(self.frame_value(frame_ID, n))
+            elif item[0] == frame_ID:
+                body = item[1] if not isinstance(item[1], list) else \
+                       b''.join(map(bytes, item[1]))
+                values.append(decode_frame(frame_ID, bytes(body),
+                                           self.encodings))
+        return values
+
+    def frame_APIC(self, n=0):
         # <Header for 'Attached picture', ID: "APIC">
         # Text encoding   $xx
         # MIME type       <text string> $00
         # Picture type    $xx
         # Description     <text string according to encoding> $00 (00)
         # Picture data    <binary data>
-        _define = ("Other",
-                   "32x32 pixels 'file icon' (PNG only)",
-                   "Other file icon",
-                   "Cover (front)",
-                   "Cover (back)",
-                   "Leaflet page",
-                   "Media (e.g. label side of CD)",
-                   "Lead artist/lead performer/soloist",
-                   "Artist/performer",
-                   "Conductor",
-                   "Band/Orchestra",
-                   "Composer",
-                   "Lyricist/text writer",
-                   "Recording Location",
-                   "During recording",
-                   "During performance",
-                   "Movie/video screen capture",
-                   "A bright coloured fish",
-                   "Illustration",
-                   "Band/artist logotype",
-                   "Publisher/Studio logotype")
-        end = self._buffer.labelseek("APIC", 0)
-        encoding, = self._buffer.unpack('!B')
-        MIME = self._buffer.read2().decode()
-        picType, = self._buffer.unpack('!B')
-        try:
-            picType = _define[picType]
-        except IndexError:
-            raise IndexError("unkonwn picture type: %s" % picType)
-        if encoding:
-            desc = self._buffer.read2().decode('utf16')
-        else:
-            desc = self._buffer.read2().decode('gbk')
-        info = [MIME, picType, desc]
-        imageData = self._buffer.read(end - self._buffer.tell())
+        # n is the number of APIC frame if there are several.
+        buffer, end, *info = self._APIC_header(n)
+        info[1] = picture_type(info[1])
+        imageData = buffer.read(end - buffer.tell())
         return imageData, info
 
+    def picture_info(self, n=0):
+        '''Return infos of the nth APIC frame as frame_APIC does, but
+        without reading the picture data.
+        '''
+        buffer, end, *info = self._APIC_header(n)
+        info[1] = picture_type(info[1])
+        return info
+
+    def _APIC_header(self, n=0):
+        # Read APIC frame till the picture data, leaving the pointer of
+        # returned buffer there. A frame not stored as it is gets a buffer
+        # of its own.
+        if self._transformed(self._buffer.label("APIC", n)):
+            buffer = AudioContextBuffer(self.frame_body("APIC", n))
+            end = buffer.seek(0, 2)
+            buffer.seek(0)
+        else:
+            buffer = self._buffer
+            end = buffer.labelseek("APIC", 0, n)
+        encoding, = buffer.unpack('!B')
+        MIME = str(buffer.read2(), 'latin-1')
+        picType, = buffer.unpack('!B')
+        desc = str(buffer.read2(_terminator(encoding)),
+                   self.encodings[encoding])
+        return buffer, end, MIME, picType, desc
+
+    def picture(self, n=0):
+        '''Return picture type number, MIME type, description and data of
+        the nth APIC frame, where data is a view of the tag in buffer (or
+        of the frame body if it isn't stored as it is), not a copy.
+        '''
+        buffer, end, MIME, picType, desc = self._APIC_header(n)
+        return picType, MIME, desc, buffer.getbuffer()[buffer.tell() : end]
+
+    def picture_range(self, n=0):
+        '''Return offset and length of the nth picture data in the file.
+        '''
+        if self.unsync or self._transformed(self._buffer.label("APIC", n)):
+            raise ValueError("picture data isn't stored as it is in file")
+        end = self._APIC_header(n)[1]
+        offset = self._buffer.tell()
+        return offset, end - offset
+
+    def frame_copy(self, *frames, invert=0):
+        '''Return raw frames of given IDs (or all the others with invert)
+        as build_frame_* functions do, to be written into a new tag.
+        '''
+        raw_frame = []
+        n = {}
+        for record in self.index:
+            k = n[record.id] = n.get(record.id, -1) + 1
+            if (record.id in frames) == bool(invert):
+                continue
+            raw_frame.append(self._copy_record(record, k))
+        return raw_frame
+
+    def _copy_record(self, record, k):
+        # frames are always written as ID3v2.3, so a v2.4 frame is stored
+        # as its plain body and its status flags are moved
+        body = self._buffer[record.id, k]
+        flags = record.flags
+        if self.ver[0] == 4 and not flags & 0x0004:
+            body = self.frame_body(record.id, k)
+            flags = (flags >> 8 & 0x70) << 9
+        length = len(body)
+        header = _FRAME_HEADER.pack(record.id.encode(), length, flags)
+        return header + bytes(body), length + 10
+
+    def _encode(self, ID, value):
+        # A str is taken as text of text information frame (a list of str
+        # for multiple values, joined by '/' in ID3v2.3 which only reads the
+        # first of NUL separated ones), url of URL link frame, or text of
+        # COMM or USLT in English with empty description. COMM and USLT also
+        # take (language, description, text) as decoded.
+        if len(ID) != 4 or not ID.isalnum() or ID != ID.upper():
+            raise ValueError(f"invalid frame ID: {ID!r}")
+        if ID in ('COMM', 'USLT') and isinstance(value, tuple):
+            lan, desc, text = value
+            lan = lan.encode('latin-1')
+            if len(lan) != 3:
+                raise ValueError(f"invalid language: {value[0]!r}")
+            return b'\x01' + lan + desc.encode('utf16') + b'\x00\x00' + \
+                   text.encode('utf16')
+        texts = value if isinstance(value, list) else [value]
+        if texts and all(isinstance(text, str) for text in texts):
+            if ID[0] == 'T' and ID != 'TXXX':
+                if len(texts) > 1 and (3 if self.unsync else self.ver[0]) < 4:
+                    texts = ['/'.join(texts)]
+                return b'\x01' + b'\x00\x00'.join(text.encode('utf16')
+                                                  for text in texts)
+            elif ID[0] == 'W' and ID != 'WXXX' and len(texts) == 1:
+                return texts[0].encode('latin-1')
+            elif ID in ('COMM', 'USLT') and len(texts) == 1:
+                return self._encode(ID, ('eng', '', texts[0]))
+        return super(Mp3Context, self)._encode(ID, value)
+
+    def _edited_writer(self):
+        # Return the writer of tag with pending edits, and the length of
+        # its start which is the same as in file.
+        # Untouched frames are spliced as they are, in the version of tag,
+        # except that v2.4 frames leaning on unsynchronisation of the whole
+        # tag are written as plain v2.3 ones.
+        # Frame IDs whose frames are all untouched and large (pictures as a
+        # rule) are put first: ID3 has no room between frames, so an edit
+        # of a frame before them would move and rewrite them every time.
+        ver = 3 if self.unsync else self.ver[0]
+        writer = ID3TagWriter(ver)
+        same = 0 if self.unsync else 10
+        moved = False
+        items = self._pending()
+        large = set()
+        small = set()
+        for item in items:
+            if isinstance(item, FrameRecord) and item.length >= _LARGE_FRAME:
+                large.add(item.id)
+            else:
+                small.add(item.id if isinstance(item, FrameRecord) else item[0])
+        large -= small
+        items = [item for item in items if isinstance(item, FrameRecord) and
+                 item.id in large] + \
+                [item for item in items if not isinstance(item, FrameRecord) or
+                 item.id not in large]
+        for item in items:
+            if not isinstance(item, FrameRecord):
+                writer.add_frame(*item)
+                moved = True
+                continue
+            if ver != self.ver[0]:
+                records = self.index.getall(item.id)
+                k = next(i for i, r in enumerate(records) if r is item)
+                writer.add(self._copy_record(item, k))
+                continue
+            writer._add(self._splice(item.offset - 10, item.offset + item.length))
+            if not moved and same and item.offset - 10 == same:
+                same = item.offset + item.length
+            else:
+                moved = True
+        return writer, same
+
+    def save(self, *frames, padding=1024, atomic=False, fsync=False):
+        '''Write a new tag made of frames back to the mp3 file, or without
+        frames given, the tag with pending edits by set, replace, add and
+        remove, where only changed frames are serialized.
+        If the frames fit into the old tag, the tag is rewritten in place
+        and the rest space becomes padding, so the audio data is never
+        touched, nor the frames kept at the same place; large untouched
+        frames are moved ahead of the others, so that later edits leave
+        them in place too. Otherwise the whole file is rewritten and
+        padding bytes are reserved for future edits.
+        With atomic, the file is always rewritten aside and then renamed
+        over the original one; fsync flushes it to disk before the rename.
+        Return True if the tag was rewritten in place.
+        '''
+        if self.path is None:
+            raise ValueError("context isn't backed by a file path")
+        if frames:
+            writer = ID3TagWriter()
+            for frame in frames:
+                writer.add(frame)
+            same = 0
+        else:
+            if not self.intact:
+                raise ValueError("tag holds bytes which aren't parsed as "
+                                 "frames, saving it would lose them")
+            writer, same = self._edited_writer()
+        length = len(writer)
+        inplace = False
+        if length <= self.size:
+            writer.padding = self.size - length
+            if not atomic:
+                if same and writer.header() != bytes(self._splice(0, 10)):
+                    same = 0
+                # spliced frames may be views of the file mapped
+                write_in_place(self.path, 0, *writer.parts(), skip = same,
+                               copy = self._buffer._view is not None)
+                inplace = True
+        else:
+            writer.padding = padding
+        if not inplace:
+            rewrite_file(self.path, self.size, *writer.parts(), fsync = fsync)
+        self.reload()
+        return inplace
+
+def iter_frames(source, limit=1 << 24, window=65536):
+    '''Walk frame headers of the ID3v2 tag of source (a path, a descriptor
+    or a bytes-like object) with small reads, and yield a LazyFrame for each
+    frame in order, without reading the whole tag. Bodies are read only when
+    asked for, before the generator is exhausted or closed; see TagSource
+    for limit and window.
+    '''
+    with TagSource(source, limit, window) as src:
+        head = src.peek(0, 10)
+        if len(head) < 10:
+            raise IOError("file is too short to hold a tag")
+        id3, ver, revision, flags, size = _TAG_HEADER.unpack(head)
+        if id3 != b'ID3':
+            raise TypeError("incorrect file format")
+        if flags & 0x80 and ver < 4:
+            raise ValueError("unsynchronised ID3v2.3 tag can't be walked")
+        end = ID3_sync_safe_to_int(size) + 10
+        pos = 10
+        if flags & 0x40:
+            # extended header, its size excludes itself in v2.3
+            size, = _BE32.unpack(src.peek(pos, 4))
+            pos += ID3_sync_safe_to_int(size) if ver == 4 else size + 4
+        while pos + 10 <= end:
+            header = src.peek(pos, 10)
+            if len(header) < 10: break
+            fid, length, fflags = _FRAME_HEADER.unpack(header)
+            # reach padding
+            if length == 0 or fid[0] == 0: break
+            if ver == 4:
+                length = ID3_sync_safe_to_int(length)
+            tally('frames')
+            yield LazyFrame(fid.decode('latin-1'), pos + 10, length, fflags, src)
+            pos += 10 + length
+
+class ID3TagWriter(TagWriter):
+    """Serializer of ID3v2 tag, the frames are only joined or written once
+    with tag size computed up front.
+    """
+    def __init__(self, ver=3, padding=0):
+        super(ID3TagWriter, self).__init__(padding)
+        self.ver = ver
+
+    def add(self, frame):
+        '''Add a frame built by build_frame_* functions.
+        '''
+        self._add(frame[0])
+
+    def add_frame(self, ID, body):
+        '''Add a frame of given ID and body, which could be a list of parts
+        such as build_APIC_body gives.
+        '''
+        body = body if isinstance(body, list) else [body]
+        size = sum(map(len, body))
+        if self.ver == 4:
+            size = int_to_ID3_sync_safe(size)
+        self._add(_FRAME_HEADER.pack(ID.encode(), size, 0), *body)
+
+    def header(self):
+        length = int_to_ID3_sync_safe(self.length + self.padding)
+        return _TAG_HEADER.pack(b'ID3', self.ver, 0, 0, length)
+
+def build_frame(ID, body):
+    size = len(body)
+    header = _FRAME_HEADER.pack(ID.encode(), size, 0)
+    return header + body, size + 10
+
 def build_frame_info(ID, content):
-    content = content.encode('utf16')
-    content = struct.pack('!B', 1) + content
-    size = len(content)
-    header = struct.pack('!4sIH', ID.encode(), size, 0)
-    return header + content, size + 10
+    return build_frame(ID, b'\x01' + content.encode('utf16'))
 
 def build_frame_infos(infoDict):
     if not isinstance(infoDict, dict):
@@ -162,36 +716,45 @@ def build_frame_infos(infoDict):
 (dict requested but {type(infoDict)} given)")
     frame_infos = []
     for i in infoDict:
-        content = infoDict[i].encode('utf16')
-        content = struct.pack('!B', 1) + content
-        size = len(content)
-        header = struct.pack('!4sIH', i.encode(), size, 0)
-        frame_infos.append((header + content, size + 10))
+        frame_infos.append(build_frame_info(i, infoDict[i]))
     return frame_infos
 
-def build_frame_APIC(path, use=3, form=0):
-    if not isinstance(use, int) or use < 0 or use > 20:
-        raise ValueError(f"invalid picture type: {key!r}")
-    with open(path, 'rb') as pic:
-        imageData = pic.read()
-    if form:
-        bodyhead = struct.pack('!B10s2B', 1, b'image/png\x00', use, 0)
+def build_APIC_body(path, use=3, desc='', form=0):
+    '''Return body of an APIC frame as a list of parts, where the picture
+    is a FilePart streamed from path when the tag is written.
+    MIME type is sniffed from the picture, form (1 for PNG, 0 for JPEG)
+    only counts if it's of unknown format.
+    '''
+    info = probe_image(path)
+    if info is not None:
+        mime = info.mime
     else:
-        bodyhead = struct.pack('!B11s2B', 1, b'image/jpeg\x00', use, 0)
-    body = bodyhead + imageData
-    size = len(body)
-    header = struct.pack('!4sIH', b'APIC', size, 0)
-    return header + body, size + 10
+        mime = 'image/png' if form else 'image/jpeg'
+    return build_APIC_parts(FilePart(path), mime, use, desc)
 
-def create_ID3_tag(*frames):
-    tag = b''
-    length = 10
+def build_APIC_parts(data, mime, use=3, desc=''):
+    '''Return body of an APIC frame as a list of parts, holding picture
+    data as it is given, a bytes-like object or FilePart.
+    '''
+    if not isinstance(use, int) or use < 0 or use > 20:
+        raise ValueError(f"invalid picture type: {use!r}")
+    try:
+        encoding, desc = 0, desc.encode('latin-1') + b'\x00'
+    except UnicodeEncodeError:
+        encoding, desc = 1, desc.encode('utf16') + b'\x00\x00'
+    bodyhead = b''.join((struct.pack('!B', encoding), mime.encode(), b'\x00',
+                         struct.pack('!B', use), desc))
+    return [bodyhead, data]
+
+def build_frame_APIC(path, use=3, form=0, desc=''):
+    body = build_APIC_body(path, use, desc, form)
+    return build_frame('APIC', b''.join(map(bytes, body)))
+
+def create_ID3_tag(*frames, padding=0):
+    writer = ID3TagWriter(padding = padding)
     for frame in frames:
-        tag += frame[0]
-        length += frame[-1]
-    length = int_to_ID3_sync_safe(length)
-    tag = struct.pack('!3s3BI', b'ID3', 3, 0, 0, length) + tag
-    return tag
+        writer.add(frame)
+    return writer.getvalue()
 
 def test(path):
     s = Mp3Context(path)
@@ -203,14 +766,61 @@ def test(path):
     bytes_to_file(pic_path, picData)
     print(f'---Export picture to {pic_path!r}...')
     print(f'Picture infos: {picInfo}')
+    import io
+    buffer = io.BytesIO()
+    assert s.export_picture(buffer) == len(picData)
+    assert buffer.getvalue() == bytes(picData)
+    print('---Export picture to io.BytesIO: ok')
+    
+def test_roundtrip(path):
+    # Edit a copy of path, save it in place and then rewritten as a whole,
+    # and check that after parsing it again the edits are there while the
+    # other frames and audio data are as they were.
+    import os, shutil, tempfile
+    def bodies(s):
+        n = {}
+        items = []
+        for record in s.index:
+            if record.id not in ('TIT2', 'TPE1', 'COMM'):
+                k = n[record.id] = n.get(record.id, -1) + 1
+                items.append((record.id, bytes(s.frame_body(record.id, k))))
+        # large frames may be moved ahead, only the order of one ID counts
+        return sorted(items, key = lambda item: item[0])
+    def audio(s):
+        offset, length = s.audio_range()
+        with open(s.path, 'rb') as f:
+            f.seek(offset)
+            return f.read(length)
+    with tempfile.TemporaryDirectory() as tmp:
+        copy = shutil.copy(path, os.path.join(tmp, os.path.basename(path)))
+        s = Mp3Context(copy)
+        frames, data = bodies(s), audio(s)
+        comments = [s.frame_value('COMM', n) for n in range(s.index.count('COMM'))]
+        for atomic in (False, True):
+            s = Mp3Context(copy)
+            title = f'Round trip {atomic}'
+            s.set('TIT2', title)
+            s.remove('TPE1')
+            s.add('COMM', ('eng', 'roundtrip', title))
+            comments.append(('eng', 'roundtrip', title))
+            inplace = s.save(atomic = atomic)
+            s = Mp3Context(copy)
+            assert s.frame_value('TIT2') == title
+            assert 'TPE1' not in s.index
+            assert [s.frame_value('COMM', n)
+                    for n in range(s.index.count('COMM'))] == comments
+            assert bodies(s) == frames
+            assert audio(s) == data
+            print(f'---Round trip saving {"in place" if inplace else "by rewriting"}: ok')
     
 
 if __name__ == '__main__':
     import os
     workpath = os.getcwd()
-    path = os.path.join(workpath, r"file\test.mp3")
-    newpath = os.path.join(workpath, r"file\test_new.mp3")
+    path = os.path.join(workpath, "file", "test.mp3")
+    newpath = os.path.join(workpath, "file", "test_new.mp3")
     test(path)
+    test_roundtrip(path)
     
     s = Mp3Context(path)
     infos = s.frame_Info()
@@ -221,7 +831,7 @@ if __name__ == '__main__':
     del infos["TPE1"]
     frames = build_frame_infos(infos)
     frame1 = build_frame_info("TPE1", "Andrew Prahlow")
-    frame2 = build_frame_APIC(os.path.join(workpath, r"file\test.jpg"))
+    frame2 = build_frame_APIC(os.path.join(workpath, "file", "test.jpg"))
     tag = create_ID3_tag(*frames, frame1, frame2)
     bytes_to_file(newpath, tag)
     copy_file(newpath, path, s.size, exist_ok = True)
@@ -0,0 +1,413 @@
+from util import *
+from mp3 import Mp3Context
+from library import open_context, _pooled
+from mapping import id3_to_vorbis
+from array import array
+from bisect import bisect_left
+from collections import namedtuple
+import os
+import sys
+import mmap
+import struct
+
+__all__ = ['StoreEntry', 'read_entry', 'TrackStore']
+
+# Compact result of parsing one audio file. tags is a list of (field name,
+# value) of vorbis comments, or of those mapped from ID3 frames for mp3;
+# picture is the offset and length of the first picture data in the file,
+# or None.
+StoreEntry = namedtuple('StoreEntry', ('path', 'format', 'size', 'tags',
+                                       'picture'))
+
+# string id of a missing value
+_MISSING = 0xffffffff
+# columns every store has, others are string ids of tag fields
+_FIXED = {'path': 'I', 'format': 'I', 'size': 'Q',
+          'picture_offset': 'Q', 'picture_length': 'Q'}
+# magic, version, byte order, tracks, strings and columns
+_HEADER = struct.Struct('<4sBB2xQQQ')
+# name id, typecode and offset of a column
+_COLUMN = struct.Struct('<Ic3xQ')
+
+def _entry(ctx):
+    if isinstance(ctx, Mp3Context):
+        tags = id3_to_vorbis(ctx)
+        ID = 'APIC'
+    else:
+        tags = [(name.upper(), value) for name, value in
+                ctx.vorbis_comments()[1]] \
+               if 'VORBIS_COMMENT' in ctx.blocklist else []
+        ID = 'PICTURE'
+    picture = None
+    if ID in ctx.index:
+        try:
+            picture = ctx.picture_range()
+        except ValueError:
+            # compressed or unsynchronised, no range to refer to
+            pass
+    return StoreEntry(ctx.path, ctx.tag, ctx.size, tags, picture)
+
+def read_entry(path):
+    '''Parse an audio file into a StoreEntry. Return None if it's not a
+    supported audio file.
+    '''
+    try:
+        ctx = open_context(path)
+    except NotAudioError:
+        return None
+    return _entry(ctx)
+
+def _read_one(path):
+    try:
+        return read_entry(path)
+    except Exception as e:
+        return e
+
+def _pad(n):
+    return -n % 8
+
+def _typecode(column):
+    # Columns are arrays, or memoryviews of a loaded store.
+    return column.typecode if isinstance(column, array) else column.format
+
+class _StringTable():
+    # Interned strings, either a list with a dict of ids, or sorted by
+    # UTF-8 bytes in a mapped file, looked up by binary search.
+    __slots__ = '_list', '_ids', '_offsets', '_blob'
+
+    def __init__(self, offsets=None, blob=None):
+        self._list = self._ids = None
+        self._offsets = offsets
+        self._blob = blob
+        if offsets is None:
+            self._list = []
+            self._ids = {}
+
+    def __len__(self):
+        if self._list is None:
+            return len(self._offsets) - 1
+        return len(self._list)
+
+    def __getitem__(self, i):
+        if self._list is None:
+            return str(self._bytes(i), 'utf-8')
+        return self._list[i]
+
+    def _bytes(self, i):
+        return bytes(self._blob[self._offsets[i] : self._offsets[i + 1]])
+
+    def find(self, s):
+        '''Return id of a string, or None if it isn't interned.
+        '''
+        if self._list is not None:
+            return self._ids.get(s)
+        key = s.encode()
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._bytes(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self) and self._bytes(lo) == key:
+            return lo
+        return None
+
+    def thaw(self):
+        if self._list is None:
+            self._list = [self[i] for i in range(len(self))]
+            self._ids = {s: i for i, s in enumerate(self._list)}
+            self._offsets = self._blob = None
+
+    def intern(self, s):
+        self.thaw()
+        i = self._ids.get(s)
+        if i is None:
+            i = self._ids[s] = len(self._list)
+            self._list.append(s)
+        return i
+
+class TrackStore():
+    """Columnar in-memory store of metadata of many tracks.
+    Every field is a column backed by an array, where tag values are ids of
+    interned strings, so a value shared by many tracks (an album, artist
+    or genre) is held once; pictures are referred to by their offset and
+    length in file, never held. Repeated fields keep their values joined
+    by NUL, and read back as a list.
+    A saved store is loaded by mapping the file, with columns and strings
+    used in place until it's changed, so loading takes no time to parse.
+    """
+    _MAGIC = b'TSTO'
+    _VERSION = 1
+
+    def __init__(self):
+        self._strings = _StringTable()
+        self._columns = {name: array(code) for name, code in _FIXED.items()}
+        self._rows = None
+        self._map = None
+        self._views = []
+
+    def __len__(self):
+        return len(self._columns['path'])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def fields(self):
+        '''Return a list of names of tag fields.
+        '''
+        return [name for name in self._columns if name not in _FIXED]
+
+    def add(self, entry):
+        '''Add a track from a StoreEntry or a context object, replacing the
+        one of the same path. Return its row number.
+        '''
+        if isinstance(entry, AudioContext):
+            entry = _entry(entry)
+        self._thaw()
+        intern = self._strings.intern
+        path = intern(entry.path)
+        values = {}
+        for name, value in entry.tags:
+            name = name.upper()
+            values[name] = values[name] + '\x00' + value \
+                           if name in values else value
+        offset, length = entry.picture or (0, 0)
+        row = {'path': path, 'format': intern(entry.format),
+               'size': entry.size, 'picture_offset': offset,
+               'picture_length': length}
+        for name, value in values.items():
+            row[name] = intern(value)
+            if name not in self._columns:
+                self._columns[name] = array('I', [_MISSING]) * len(self)
+        n = self._index().get(path)
+        if n is None:
+            n = self._rows[path] = len(self)
+            for name, column in self._columns.items():
+                column.append(row.get(name, _MISSING))
+        else:
+            for name, column in self._columns.items():
+                column[n] = row.get(name, _MISSING)
+        tally('store.tracks')
+        return n
+
+    def ingest(self, paths, workers=None, executor='thread', pending=None):
+        '''Parse many audio files in a pool and add them, as scan takes the
+        arguments. Files which aren't mp3 or flac are skipped. Return a
+        list of (path, exception) of files failed to parse.
+        '''
+        failed = []
+        for path, entry in _pooled(_read_one, paths, workers, executor,
+                                   pending, None, None):
+            if isinstance(entry, Exception):
+                failed.append((path, entry))
+            elif entry is not None:
+                self.add(entry)
+        return failed
+
+    def lookup(self, path):
+        '''Return row number of the track of given path.
+        '''
+        i = self._strings.find(path)
+        if i is not None:
+            if self._map is None:
+                n = self._index().get(i)
+                if n is not None:
+                    return n
+            else:
+                # rows of a loaded store are sorted by path
+                column = self._columns['path']
+                n = bisect_left(column, i)
+                if n < len(column) and column[n] == i:
+                    return n
+        raise KeyError(f"track {path!r} isn't stored")
+
+    def get(self, n, field, default=None):
+        '''Return value of a field of the nth track, a str, a list of str
+        for repeated tag fields, or an int for size and picture columns.
+        '''
+        field = field.upper() if field not in self._columns else field
+        column = self._columns.get(field)
+        if column is None:
+            return default
+        value = column[n]
+        if _typecode(column) == 'I':
+            return default if value == _MISSING else self._value(value)
+        return value
+
+    def track(self, n):
+        '''Return a dict of path, format, size, tags and picture of the nth
+        track as StoreEntry holds, with tags as a dict.
+        '''
+        tags = {}
+        for name in self.fields():
+            value = self.get(n, name)
+            if value is not None:
+                tags[name] = value
+        length = self._columns['picture_length'][n]
+        return {'path': self.get(n, 'path'), 'format': self.get(n, 'format'),
+                'size': self.get(n, 'size'), 'tags': tags,
+                'picture': (self._columns['picture_offset'][n], length)
+                           if length else None}
+
+    def picture_range(self, n):
+        '''Return offset and length of the picture data of the nth track in
+        its file, or None if it has no picture.
+        '''
+        length = self._columns['picture_length'][n]
+        if not length:
+            return None
+        return self._columns['picture_offset'][n], length
+
+    def filter(self, field, predicate):
+        '''Return row numbers of tracks whose value of field satisfies
+        predicate, in row order. For string columns, predicate is called
+        once for each distinct value, not for each track.
+        '''
+        field = field.upper() if field not in self._columns else field
+        column = self._columns.get(field)
+        if column is None:
+            return []
+        if _typecode(column) != 'I':
+            return [n for n, value in enumerate(column) if predicate(value)]
+        ids = {i for i in set(column)
+               if i != _MISSING and predicate(self._value(i))}
+        return [n for n, i in enumerate(column) if i in ids]
+
+    def find(self, field, value):
+        '''Return row numbers of tracks with given value of field, or with
+        it among values of a repeated field.
+        '''
+        return self.filter(field, lambda v: v == value or
+                           isinstance(v, list) and value in v)
+
+    def _value(self, i):
+        value = self._strings[i]
+        return value.split('\x00') if '\x00' in value else value
+
+    def _index(self):
+        # Row numbers by path id, only for a store not loaded from file.
+        if self._rows is None:
+            self._rows = {i: n for n, i in enumerate(self._columns['path'])}
+        return self._rows
+
+    def _thaw(self):
+        # Copy columns and strings of a loaded store into memory to be
+        # changed, and release the file.
+        if self._map is None:
+            return
+        self._strings.thaw()
+        self._columns = {name: array(column.format, column.tobytes())
+                         for name, column in self._columns.items()}
+        self._rows = None
+        self._index()
+        self.close()
+
+    def save(self, path):
+        '''Write the store to a file, replaced atomically. Strings are sorted
+        and tracks ordered by path on the way, so the file can be searched
+        without building any index when it's loaded.
+        '''
+        self._thaw()
+        strings = self._strings
+        names = {name: strings.intern(name) for name in self._columns}
+        encoded = [strings[i].encode() for i in range(len(strings))]
+        order = sorted(range(len(encoded)), key = encoded.__getitem__)
+        remap = array('I', bytes(4 * len(order)))
+        for new, old in enumerate(order):
+            remap[old] = new
+        paths = self._columns['path']
+        rows = sorted(range(len(self)), key = lambda n: remap[paths[n]])
+        offsets = array('Q', [0])
+        for i in order:
+            offsets.append(offsets[-1] + len(encoded[i]))
+        pos = _HEADER.size + _COLUMN.size * len(self._columns)
+        pos += 8 * len(offsets)
+        blob_end = pos + offsets[-1]
+        pos = blob_end + _pad(blob_end)
+        directory = []
+        for name, column in self._columns.items():
+            directory.append(_COLUMN.pack(remap[names[name]],
+                                          column.typecode.encode(), pos))
+            size = len(rows) * column.itemsize
+            pos += size + _pad(size)
+        f, tmppath = temp_file(path)
+        try:
+            with f:
+                f.write(_HEADER.pack(self._MAGIC, self._VERSION,
+                                     sys.byteorder == 'little', len(rows),
+                                     len(order), len(directory)))
+                f.write(b''.join(directory))
+                f.write(offsets.tobytes())
+                f.write(b''.join(encoded[i] for i in order))
+                f.write(bytes(_pad(blob_end)))
+                for column in self._columns.values():
+                    if column.typecode == 'I':
+                        data = array('I', (_MISSING if column[n] == _MISSING
+                                           else remap[column[n]] for n in rows))
+                    else:
+                        data = array(column.typecode, (column[n] for n in rows))
+                    f.write(data.tobytes())
+                    f.write(bytes(_pad(len(data) * data.itemsize)))
+            os.replace(tmppath, path)
+        except BaseException:
+            os.unlink(tmppath)
+            raise
+        tally('store.saved', len(rows))
+
+    @classmethod
+    def load(cls, path):
+        '''Load a store saved by save, mapping the file into memory.
+        '''
+        self = cls()
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        try:
+            view = self._view(0, len(self._map))
+            magic, version, little, tracks, nstrings, ncolumns = \
+                   _HEADER.unpack_from(view)
+            if magic != cls._MAGIC or version != cls._VERSION:
+                raise ValueError(f"{path} isn't a track store")
+            if little != (sys.byteorder == 'little'):
+                raise ValueError(f"{path} is saved in other byte order")
+            pos = _HEADER.size + _COLUMN.size * ncolumns
+            offsets = self._view(pos, 8 * (nstrings + 1), 'Q')
+            pos += 8 * (nstrings + 1)
+            self._strings = _StringTable(offsets,
+                                         self._view(pos, offsets[-1]))
+            self._columns = {}
+            for i in range(ncolumns):
+                name, code, start = _COLUMN.unpack_from(view, _HEADER.size +
+                                                        _COLUMN.size * i)
+                code = code.decode()
+                self._columns[self._strings[name]] = \
+                    self._view(start, tracks * array(code).itemsize, code)
+        except BaseException:
+            self.close()
+            raise
+        tally('store.loaded', tracks)
+        return self
+
+    def _view(self, offset, size, code='B'):
+        view = memoryview(self._map)[offset : offset + size]
+        self._views.append(view)
+        if len(view) != size:
+            raise ValueError("track store is truncated")
+        if code != 'B':
+            view = view.cast(code)
+            self._views.append(view)
+        return view
+
+    def close(self):
+        '''Release the mapped file of a loaded store, which can't be used
+        after unless it has been changed.
+        '''
+        if self._map is not None:
+            for view in reversed(self._views):
+                view.release()
+            self._views.clear()
+            self._map.close()
+            self._map = None
@@ -1,7 +1,142 @@
-import os.path
-from struct import calcsize, unpack_from
+import os
+import sys
+import mmap
+import hashlib
+import stat
+import time
+import threading
+from collections import namedtuple
+from contextlib import contextmanager, nullcontext
+from struct import Struct, calcsize, unpack_from
 
-__all__ = ['AudioContext','AudioContextBuffer','bytes_to_file','copy_file']
+__all__ = ['AudioContext','AudioContextBuffer','bytes_to_file','copy_file',
+           'TagWriter','zero_parts','writeall','write_in_place','write_ranges',
+           'rewrite_file','temp_file',
+           'fsync_dir','copy_range','picture_type','AudioInfo','ImageInfo',
+           'probe_image','FilePart','FrameRecord','LazyFrame','TagSource',
+           'FrameIndex','Instrument','NotAudioError',
+           'enable_instrument','disable_instrument','current_instrument',
+           'timed','tally']
+
+# Picture types of ID3v2 APIC frame, also used by FLAC PICTURE block
+_PICTURE_TYPES = ("Other",
+                  "32x32 pixels 'file icon' (PNG only)",
+                  "Other file icon",
+                  "Cover (front)",
+                  "Cover (back)",
+                  "Leaflet page",
+                  "Media (e.g. label side of CD)",
+                  "Lead artist/lead performer/soloist",
+                  "Artist/performer",
+                  "Conductor",
+                  "Band/Orchestra",
+                  "Composer",
+                  "Lyricist/text writer",
+                  "Recording Location",
+                  "During recording",
+                  "During performance",
+                  "Movie/video screen capture",
+                  "A bright coloured fish",
+                  "Illustration",
+                  "Band/artist logotype",
+                  "Publisher/Studio logotype")
+
+# Properties of audio data. duration is in seconds and bitrate in bits per
+# second, both None if unknown; source tells where they come from, e.g.
+# 'xing', 'vbri', 'scan', 'estimate' or 'streaminfo'.
+AudioInfo = namedtuple('AudioInfo', ('duration', 'bitrate', 'sample_rate',
+                                     'channels', 'source'))
+
+# Format of a picture: MIME type, width and height in pixels, color depth
+# in bits per pixel and the number of colors for indexed-color pictures
+# (0 for others), as PICTURE block of flac holds.
+ImageInfo = namedtuple('ImageInfo', ('mime', 'width', 'height', 'depth',
+                                     'colors'))
+
+class Instrument():
+    """Counters of hot paths: wall time and calls of phases, bytes read and
+    written, system calls, frames and blocks.
+    Each thread counts into its own dict, and asdict aggregates them.
+    hook, if given, is called with (name, value) on every count.
+    """
+    def __init__(self, hook=None):
+        self.hook = hook
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._counters = []
+
+    def add(self, name, value=1):
+        try:
+            counter = self._local.counter
+        except AttributeError:
+            counter = self._local.counter = {}
+            with self._lock:
+                self._counters.append(counter)
+        counter[name] = counter.get(name, 0) + value
+        if self.hook is not None:
+            self.hook(name, value)
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name + '.seconds', time.perf_counter() - start)
+            self.add(name + '.calls')
+
+    def asdict(self):
+        '''Return all counters summed over threads.
+        '''
+        total = {}
+        with self._lock:
+            counters = list(self._counters)
+        for counter in counters:
+            for name, value in list(counter.items()):
+                total[name] = total.get(name, 0) + value
+        return dict(sorted(total.items()))
+
+    def reset(self):
+        with self._lock:
+            for counter in self._counters:
+                counter.clear()
+
+_instrument = None
+_nophase = nullcontext()
+
+def enable_instrument(hook=None):
+    '''Start counting hot paths of all threads into a new Instrument
+    object, and return it.
+    '''
+    global _instrument
+    _instrument = Instrument(hook)
+    return _instrument
+
+def disable_instrument():
+    '''Stop counting, return the Instrument object which was in use.
+    '''
+    global _instrument
+    instrument, _instrument = _instrument, None
+    return instrument
+
+def current_instrument():
+    return _instrument
+
+def timed(name):
+    '''Context manager timing a phase, a no-op unless instrument enabled.
+    '''
+    if _instrument is None:
+        return _nophase
+    return _instrument.phase(name)
+
+def tally(name, value=1):
+    '''Add value to a counter, a no-op unless instrument enabled.
+    '''
+    if _instrument is not None:
+        _instrument.add(name, value)
+
+class NotAudioError(ValueError):
+    """The file isn't of a supported audio format."""
 
 class AudioContext():
     """The abstract base class for all audio context classes."""
@@ -9,19 +144,193 @@ class AudioContext():
     _buffer = None
     _define = ()
 
-    def __init__(self, filepath):
-        self.path = filepath
-        self._tagcheck()
-        self.size = self._getsize()
+    def __init__(self, source, use_mmap=False, probe_size=65536, fd=None,
+                 head=None):
+        '''source is a file path, an opened file descriptor or a bytes-like
+        object holding the file (or at least its tag). A descriptor, either
+        as source or as fd of the file at path, is left open; the latter is
+        only used while initializing.
+        The file is opened only once and probe_size bytes at its start,
+        which usually cover the whole tag, are read by one call; further
+        reads only happen for larger tags. head could be given as those
+        bytes already read by the caller, then it isn't read again.
+        '''
+        self.path = None
+        self.fd = fd
+        self._decoded = {}
+        self._edits = None
+        self.use_mmap = use_mmap
+        self.probe_size = probe_size
+        self._data = None
+        if isinstance(source, int):
+            self.fd = source
+        elif isinstance(source, (bytes, bytearray, memoryview)):
+            self._data = memoryview(source)
+        else:
+            self.path = source
+        if self._data is None and self.fd is None:
+            try:
+                with timed('open'):
+                    self._fd = os.open(self.path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+            except OSError as e:
+                raise IOError(e)
+            tally('syscalls.open')
+        else:
+            self._fd = self.fd
+        try:
+            with timed('read'):
+                if head is None:
+                    head = self._pread(probe_size, 0)
+                self._tagcheck(head)
+                self.size = self._getsize(head)
+                self._buffer = self._loadbuffer(head)
+        finally:
+            if self._fd is not self.fd:
+                os.close(self._fd)
+            self._fd = None
+            if self.path is not None:
+                self.fd = None
+
+    def _pread(self, size, offset):
+        '''Read size bytes at offset of source while initializing.
+        '''
+        if self._data is not None:
+            return self._data[offset : offset + size]
+        if hasattr(os, 'pread'):
+            b = os.pread(self._fd, size, offset)
+        else:
+            os.lseek(self._fd, offset, 0)
+            b = os.read(self._fd, size)
+        tally('syscalls.read')
+        tally('bytes_read', len(b))
+        return b
+
+    def _loadbuffer(self, head):
+        '''Return an AudioContextBuffer object holding the whole tag,
+        reusing head probed from the start of source.
+        With use_mmap, the buffer maps the file (or wraps the bytes-like
+        source) instead of copying it, and its labels and reads are
+        memoryview slices of the mapping.
+        '''
+        if self.use_mmap:
+            if self._data is not None:
+                return AudioContextBuffer.frombuffer(self._data[:self.size])
+            return AudioContextBuffer.mapfile(self._fd, self.size)
+        if self.size <= len(head):
+            return AudioContextBuffer(memoryview(head)[:self.size])
+        rest = self._pread(self.size - len(head), len(head))
+        buffer = AudioContextBuffer(head)
+        buffer._buf += rest
+        return buffer
 
-    def _tagcheck(self):
+    def reload(self):
+        '''Read the tag from file again, e.g. after it has been saved.
+        '''
+        if self.path is None:
+            raise ValueError("context isn't backed by a file path")
+        self.__init__(self.path, self.use_mmap, self.probe_size)
+
+    @contextmanager
+    def _opened(self):
+        '''Make _pread usable again after initializing, opening the file at
+        path once for the block.
+        '''
+        if self._data is not None or self.path is None:
+            self._fd = self.fd
+            try:
+                yield
+            finally:
+                self._fd = None
+            return
+        try:
+            with timed('open'):
+                self._fd = os.open(self.path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        except OSError as e:
+            raise IOError(e)
+        tally('syscalls.open')
+        try:
+            yield
+        finally:
+            os.close(self._fd)
+            self._fd = None
+
+    def _filesize(self):
+        if self._data is not None:
+            return len(self._data)
+        return os.fstat(self._fd).st_size
+
+    def audio_range(self):
+        '''Return offset and length of audio data in file, which follows
+        the tag and precedes ID3v1 and APEv2 tags at the end if any.
+        '''
+        with self._opened():
+            return self._audio_range()
+
+    def _audio_range(self):
+        end = self._filesize()
+        if end - 128 >= self.size and self._pread(3, end - 128) == b'TAG':
+            end -= 128
+        if end - 32 >= self.size:
+            footer = self._pread(32, end - 32)
+            if footer[:8] == b'APETAGEX':
+                # size counts items and footer, and the header if flagged
+                size, items, flags = unpack_from('<3I', footer, 12)
+                if flags & 0x80000000:
+                    size += 32
+                end = max(self.size, end - size)
+        return self.size, max(0, end - self.size)
+
+    def fingerprint(self, algorithm='blake2b', chunk=1 << 22):
+        '''Return hex digest of the audio data only, as audio_range gives,
+        so copies of a recording which differ only in tags hash the same.
+        '''
+        with self._opened():
+            offset, length = self._audio_range()
+            return self._hash_range(offset, length, algorithm, chunk)
+
+    def hash_range(self, offset, length, algorithm='sha256', chunk=1 << 22):
+        '''Return hex digest of length bytes at offset of file, e.g. the
+        range of picture_range. The file is mapped and hashed in chunks of
+        given size.
+        '''
+        with self._opened():
+            return self._hash_range(offset, length, algorithm, chunk)
+
+    def _hash_range(self, offset, length, algorithm, chunk):
+        h = hashlib.new(algorithm)
+        with timed('hash'):
+            if self._data is not None:
+                _hash_view(h, self._data, offset, length, chunk)
+            elif length:
+                try:
+                    m = mmap.mmap(self._fd, 0, access=mmap.ACCESS_READ)
+                except (OSError, ValueError):
+                    # not mappable, read it piece by piece
+                    for pos in range(offset, offset + length, chunk):
+                        h.update(self._pread(min(chunk, offset + length - pos), pos))
+                else:
+                    tally('syscalls.mmap')
+                    with m:
+                        if hasattr(m, 'madvise'):
+                            m.madvise(mmap.MADV_SEQUENTIAL)
+                        view = memoryview(m)
+                        try:
+                            _hash_view(h, view, offset, length, chunk)
+                        finally:
+                            view.release()
+        tally('bytes_hashed', length)
+        return h.hexdigest()
+
+    def _tagcheck(self, head):
         '''Check if the tag type of audio file correspond to subclass.
+        head is the bytes probed from the start of file.
         '''
         pass
 
-    def _getsize(self):
+    def _getsize(self, head):
         '''Return size of the whole tag.
-        This reads original file directly.
+        This reads head probed from the start of file, and original file
+        by self._pread if head isn't long enough.
         '''
         return 0
 
@@ -33,14 +342,362 @@ class AudioContext():
         '''
         pass
 
+    def save(self, *args, padding=1024, atomic=False, fsync=False):
+        '''Write a new tag back to the audio file.
+        The tag is rewritten in place when it fits into the old one, or
+        the whole file is rewritten with padding reserved for later edits.
+        With atomic, the file is always rewritten aside and renamed over, so
+        a crash leaves either the old or the new file; fsync flushes the new
+        file before the rename.
+        '''
+        raise NotImplementedError
+
+    def _memo(self, key, func, *args):
+        '''Return the value memoized by key, calling func(*args) to decode
+        it only on the first access. key starts with the frame or block ID.
+        '''
+        try:
+            value = self._decoded[key]
+        except KeyError:
+            value = self._decoded[key] = func(*args)
+            tally('memo.misses')
+        else:
+            tally('memo.hits')
+        return value
+
+    def invalidate(self, *ids):
+        '''Drop decoded values memoized for frames or blocks of given IDs,
+        or all of them if no ID given, so they are decoded again on next
+        access, e.g. after the tag or the text encodings changed.
+        '''
+        if not ids:
+            self._decoded.clear()
+            return
+        for key in list(self._decoded):
+            if key[0] in ids:
+                del self._decoded[key]
+
+    def set(self, ID, value):
+        '''Set a frame or block of given ID to value, replacing all the
+        existing ones, at the place of the first one or at the end.
+        Edits are pending until save is called without arguments, which
+        only serializes the changed ones and splices the others as they are.
+        '''
+        body = self._encode(ID, value)
+        edits = self._pending()
+        places = self._places(ID)
+        if places:
+            edits[places[0]] = (ID, body)
+            for i in reversed(places[1:]):
+                del edits[i]
+        else:
+            edits.append((ID, body))
+        self.invalidate(ID)
+
+    def replace(self, ID, value, n=0):
+        '''Replace the nth frame or block of given ID by value, keeping its
+        place.
+        '''
+        body = self._encode(ID, value)
+        places = self._places(ID)
+        try:
+            self._edits[places[n]] = (ID, body)
+        except IndexError:
+            raise KeyError(f"label {ID!r} doesn't exist")
+        self.invalidate(ID)
+
+    def add(self, ID, value):
+        '''Add a frame or block of given ID at the end, e.g. one more APIC.
+        '''
+        self._pending().append((ID, self._encode(ID, value)))
+        self.invalidate(ID)
+
+    def remove(self, ID, n=None):
+        '''Remove the nth frame or block of given ID, or all of them.
+        '''
+        places = self._places(ID)
+        if n is not None:
+            try:
+                places = [places[n]]
+            except IndexError:
+                raise KeyError(f"label {ID!r} doesn't exist")
+        for i in reversed(places):
+            del self._edits[i]
+        self.invalidate(ID)
+
+    def revert(self):
+        '''Drop all pending edits.
+        '''
+        self._edits = None
+        self.invalidate()
+
+    @property
+    def edited(self):
+        '''If there are pending edits, which leave the tag different from
+        the one in file.
+        '''
+        if self._edits is None:
+            return False
+        index = list(self.index)
+        return len(self._edits) != len(index) or \
+               any(item is not record for item, record in zip(self._edits, index))
+
+    def _pending(self):
+        # The new tag as a list of FrameRecord objects of untouched frames
+        # or blocks, and (ID, body) of changed ones.
+        if self._edits is None:
+            self._edits = list(self.index)
+        return self._edits
+
+    def _places(self, ID):
+        return [i for i, item in enumerate(self._pending())
+                if (item.id if isinstance(item, FrameRecord) else item[0]) == ID]
+
+    def _encode(self, ID, value):
+        '''Return body of a frame or block of given ID holding value, which
+        is a bytes-like object of the body itself by default, or a list of
+        such objects and FilePart objects.
+        '''
+        parts = value if isinstance(value, list) else [value]
+        for part in parts:
+            if not isinstance(part, (bytes, bytearray, memoryview, FilePart)):
+                raise TypeError(f"can't encode {type(part).__name__} as {ID}")
+        return value
+
+    def _splice(self, start, end):
+        # Zero-copy view of the tag in buffer, for the untouched frames.
+        return self._buffer.getbuffer()[start : end]
+
+    @property
+    def index(self):
+        '''FrameIndex object of all frames or blocks in the tag.
+        '''
+        return self._buffer._index
+
+    def picture_range(self, n=0):
+        '''Return offset and length of the nth embedded picture data
+        in file.
+        '''
+        raise NotImplementedError
+
+    def export_picture(self, dest, n=0):
+        '''Copy the nth embedded picture straight from the audio file to
+        dest, a path or a writable binary file object, without reading the
+        image into memory. A file object without a file descriptor, such as
+        io.BytesIO, is written in chunks. Return the number of bytes copied.
+        '''
+        offset, length = self.picture_range(n)
+        if isinstance(dest, (str, bytes, os.PathLike)):
+            with open(dest, 'wb') as f:
+                return self._export_range(f, offset, length)
+        return self._export_range(dest, offset, length)
+
+    def _export_range(self, dest, offset, length, chunk=1 << 20):
+        if self._data is not None:
+            return dest.write(self._data[offset : offset + length])
+        try:
+            dest.fileno()
+        except (AttributeError, OSError, ValueError):
+            # not backed by a file, read it piece by piece
+            with self._opened():
+                copied = 0
+                for pos in range(offset, offset + length, chunk):
+                    size = min(chunk, offset + length - pos)
+                    copied += dest.write(self._pread(size, pos))
+                return copied
+        if self.path is None:
+            return copy_range(self.fd, dest, offset, length)
+        with open(self.path, 'rb') as src:
+            return copy_range(src, dest, offset, length)
+
     def __call__(self):
         '''An sample implementation of __call__.
         '''
         return f"[{self.tag}]Audio Context of {self.path}"
 
+class FrameRecord():
+    """Position of a frame (or metadata block) body in tag."""
+    __slots__ = ('id', 'offset', 'length', 'flags')
+
+    def __init__(self, id, offset, length, flags=0):
+        self.id = id
+        self.offset = offset
+        self.length = length
+        self.flags = flags
+
+    def __repr__(self):
+        return (f"{type(self).__name__}({self.id!r}, {self.offset}, {self.length}, "
+                f"{self.flags})")
+
+class LazyFrame(FrameRecord):
+    """Record of a frame (or metadata block) walked from file, whose body
+    is only read when asked for, as bytes, a memoryview or chunks, from the
+    TagSource still open. A body larger than the memory limit of source is
+    only available in chunks.
+    """
+    __slots__ = ('_source',)
+
+    def __init__(self, id, offset, length, flags, source):
+        super(LazyFrame, self).__init__(id, offset, length, flags)
+        self._source = source
+
+    def _check(self):
+        if self.length > self._source.limit:
+            raise MemoryError(f"body of {self.id} ({self.length} bytes) "
+                              f"exceeds memory limit {self._source.limit}")
+
+    def read(self):
+        '''Return the body as bytes.
+        '''
+        self._check()
+        return self._source.pread(self.offset, self.length)
+
+    def view(self):
+        '''Return the body as a memoryview, without copying it further if
+        the source is a bytes-like object.
+        '''
+        self._check()
+        return self._source.view(self.offset, self.length)
+
+    def chunks(self, size=65536):
+        '''Yield the body in bytes objects of given size at most, which is
+        bounded by the memory limit too.
+        '''
+        size = max(1, min(size, self._source.limit))
+        end = self.offset + self.length
+        for pos in range(self.offset, end, size):
+            yield self._source.pread(pos, min(size, end - pos))
+
+class TagSource():
+    """File (path, descriptor or bytes-like object) which tag headers are
+    walked from with small reads. Headers are peeked through a window of
+    window bytes, and no read is larger than limit bytes.
+    """
+    def __init__(self, source, limit=1 << 24, window=65536):
+        self.limit = limit
+        self._window = min(window, limit)
+        self._data = None
+        self._fd = None
+        self._closefd = False
+        if isinstance(source, int):
+            self._fd = source
+        elif isinstance(source, (bytes, bytearray, memoryview)):
+            self._data = memoryview(source)
+        else:
+            try:
+                self._fd = os.open(source, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+            except OSError as e:
+                raise IOError(e)
+            tally('syscalls.open')
+            self._closefd = True
+        self._base = 0
+        self._buf = b''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._closefd and self._fd is not None:
+            os.close(self._fd)
+        self._fd = None
+        self._data = None
+        self._buf = b''
+
+    def pread(self, offset, size):
+        '''Read size bytes at offset.
+        '''
+        if self._data is not None:
+            return bytes(self._data[offset : offset + size])
+        if self._fd is None:
+            raise ValueError("I/O operation on closed tag source")
+        if hasattr(os, 'pread'):
+            b = os.pread(self._fd, size, offset)
+        else:
+            os.lseek(self._fd, offset, 0)
+            b = os.read(self._fd, size)
+        tally('syscalls.read')
+        tally('bytes_read', len(b))
+        return b
+
+    def view(self, offset, size):
+        if self._data is not None:
+            return self._data[offset : offset + size]
+        return memoryview(self.pread(offset, size))
+
+    def peek(self, offset, size):
+        '''Return size bytes at offset through the window, reading the
+        window again from offset when they're beyond it.
+        '''
+        i = offset - self._base
+        if i < 0 or i + size > len(self._buf):
+            self._base = offset
+            self._buf = self.pread(offset, max(size, self._window))
+            i = 0
+        return self._buf[i : i + size]
+
+class FrameIndex():
+    """Frame records in tag order, allowing repeated IDs (e.g. several APIC,
+    TXXX or PICTURE), with lookup by position or by ID and number.
+    """
+    __slots__ = ('_records', '_ids')
+
+    def __init__(self):
+        self._records = []
+        self._ids = {}
+
+    def add(self, id, offset, length, flags=0):
+        record = FrameRecord(id, offset, length, flags)
+        self._records.append(record)
+        try:
+            self._ids[id].append(record)
+        except KeyError:
+            self._ids[id] = [record]
+        return record
+
+    def get(self, id, n=0):
+        '''Return the nth record of given ID.
+        '''
+        return self._ids[id][n]
+
+    def getall(self, id):
+        '''Return a list of all records of given ID.
+        '''
+        return list(self._ids.get(id, ()))
+
+    def count(self, id):
+        return len(self._ids.get(id, ()))
+
+    def ids(self):
+        '''Return a tuple of IDs of all records in order.
+        '''
+        return tuple(record.id for record in self._records)
+
+    def __getitem__(self, i):
+        return self._records[i]
+
+    def __contains__(self, id):
+        return id in self._ids
+
+    def __iter__(self):
+        return iter(self._records)
+
+    def __len__(self):
+        return len(self._records)
+
+def _hash_view(h, view, offset, length, chunk):
+    # Feed length bytes of a memoryview from offset to hash object h. Large
+    # updates release the GIL, so files can be hashed in threads.
+    end = offset + length
+    for pos in range(offset, end, chunk):
+        h.update(view[pos : min(pos + chunk, end)])
+
 class AudioContextBuffer():
     """Buffered I/O implementation using an in-memory bytes buffer."""
     _buf = None
+    _view = None
     
     def __init__(self, initial_bytes=None):
         buf = bytearray()
@@ -48,11 +705,46 @@ class AudioContextBuffer():
             buf += initial_bytes
         self._buf = buf
         self._pos = 0
-        self._index = {}
+        self._index = FrameIndex()
+
+    @classmethod
+    def frombuffer(cls, data):
+        '''Create a read-only buffer wrapping a bytes-like object.
+        Nothing is copied: labels and reads return memoryview slices of it.
+        '''
+        self = cls.__new__(cls)
+        self._buf = data
+        self._view = memoryview(data)
+        self._pos = 0
+        self._index = FrameIndex()
+        return self
+
+    @classmethod
+    def mapfile(cls, f, size):
+        '''Create a read-only buffer over the first size bytes of an opened
+        file (object or descriptor) using mmap.
+        '''
+        fileno = f if isinstance(f, int) else f.fileno()
+        if size:
+            tally('syscalls.mmap')
+            return cls.frombuffer(mmap.mmap(fileno, size, access=mmap.ACCESS_READ))
+        # an empty file can't be mapped
+        return cls.frombuffer(b'')
+
+    def _slice(self, p1, p2):
+        if self._view is not None:
+            return self._view[p1 : p2]
+        return bytes(self._buf[p1 : p2])
 
     def __setitem__(self, key, offset):
         '''Set modified label to a part of stream between pointer and
-        the offset.
+        the offset. A label set again doesn't replace the former one, but
+        is appended as the next one of the same name.
+        '''
+        self.setlabel(key, offset)
+
+    def setlabel(self, key, offset, flags=0):
+        '''Same as setting item, with flags kept in the label record.
         '''
         if not isinstance(key, str):
             raise TypeError(f"{key!r} is not a str")
@@ -63,24 +755,33 @@ class AudioContextBuffer():
         else:
             offset = offset_index()
         if offset >= 0:
-            self._index[key] = (self._pos, self._pos + offset)
+            return self._index.add(key, self._pos, offset, flags)
         else:
-            self._index[key] = (max(0, self._pos + offset), self._pos)
+            p1 = max(0, self._pos + offset)
+            return self._index.add(key, p1, self._pos - p1, flags)
 
     def __getitem__(self, key):
-        '''Get specific bytes stream by a label.
+        '''Get specific bytes stream by a label, key is the label name or
+        a tuple of name and its number among labels of the same name.
+        '''
+        if isinstance(key, tuple):
+            record = self.label(*key)
+        else:
+            record = self.label(key)
+        return self._slice(record.offset, record.offset + record.length)
+
+    def label(self, key, n=0):
+        '''Return the record of nth label among ones of the same name.
         '''
         try:
-            p1, p2 = self._index[key]
-        except KeyError:
-            raise KeyError(f"tabel {key!r} doesn't exist")
-        b = self._buf[p1 : p2]
-        return bytes(b)
+            return self._index.get(key, n)
+        except (KeyError, IndexError):
+            raise KeyError(f"label {key!r} doesn't exist")
 
     def getvalue(self):
         '''Return the bytes value (contents) of the buffer.
         '''
-        return bytes(self._buf)
+        return self._slice(0, len(self._buf))
 
     def getbuffer(self):
         '''Return a readable and writable view of the buffer.
@@ -88,9 +789,24 @@ class AudioContextBuffer():
         return memoryview(self._buf)
 
     def flush(self):
+        if self._view is not None:
+            return
         if self._buf is not None:
             self._buf.clear()
 
+    def close(self):
+        '''Release the buffer. A mapping stays alive until all memoryview
+        slices handed out of it have been released.
+        '''
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+            try:
+                self._buf.close()
+            except (AttributeError, BufferError):
+                pass
+        self._buf = None
+
     def read(self, size=-1):
         '''Read and return up to size bytes, where size is an int,
         and returns an empty bytes array on EOF.
@@ -109,26 +825,47 @@ class AudioContextBuffer():
         if size < 0:
             size = len(self._buf)
         newpos = min(len(self._buf), self._pos + size)
-        b = self._buf[self._pos : newpos]
+        b = self._slice(self._pos, newpos)
         self._pos = newpos
-        return bytes(b)
+        return b
 
     def read2(self, end=b'\x00'):
-        '''Read and check each byte tile meeting given terminator,
-        then return.
-        Note the end must be 1 byte long byte-object.
+        '''Read till meeting given terminator, then return the bytes before
+        it and move the pointer after it. Read to the end if there's no
+        terminator.
+        Note the end must be 1 or 2 bytes long byte-object, and a 2 bytes
+        terminator (e.g. UTF-16 null) is only matched at even offsets.
         '''
-        if not isinstance(end, bytes) or len(end) != 1:
+        if not isinstance(end, bytes) or len(end) not in (1, 2):
             raise TypeError(f"{end!r} is an invalid terminator")
-        endpos = self._pos
-        for i in range(len(self._buf) - self._pos):
-            if self._buf[self._pos + i] == end[0]:
-                endpos = self._pos + i
+        n = len(end)
+        start = pos = self._pos
+        while True:
+            endpos = self._find(end, pos)
+            if endpos < 0:
+                endpos = len(self._buf)
+                break
+            if (endpos - start) % n == 0:
                 break
-        b = self._buf[self._pos : endpos]
-        self._pos = endpos + 1
-        return bytes(b)
-            
+            pos = endpos + 1
+        b = self._slice(start, endpos)
+        self._pos = endpos + n
+        return b
+
+    def _find(self, sub, start, chunk=4096):
+        try:
+            return self._buf.find(sub, start)
+        except AttributeError:
+            pass
+        # a memoryview can't be searched, copy it piece by piece
+        size = len(self._buf)
+        while start < size:
+            piece = bytes(self._buf[start : start + chunk + len(sub) - 1])
+            i = piece.find(sub)
+            if i >= 0:
+                return start + i
+            start += chunk
+        return -1
 
     def write(self, b):
         '''Write the given bytes buffer to the IO stream.
@@ -137,13 +874,15 @@ class AudioContextBuffer():
         '''
         if isinstance(b, str):
             raise TypeError("can't write str to binary stream")
+        if self._view is not None:
+            raise TypeError("can't write to a mapped buffer")
         with memoryview(b) as view:
             n = view.nbytes  # Size of any bytes-like object
         if n == 0:
             return 0
         pos = self._pos
         if pos > len(self._buf):
-            padding = b'\x00' * (pos - len(self.buf))
+            padding = b'\x00' * (pos - len(self._buf))
             self._buf += padding  # Inserts null bytes between the blanks
         self._buf[pos : pos + n] = b
         self._pos += n
@@ -165,27 +904,30 @@ class AudioContextBuffer():
         elif whence == 1:
             self._pos = max(0, self._pos + pos)
         elif whence == 2:
-            self._pos = max(0, len(self._buffer) + pos)
+            self._pos = max(0, len(self._buf) + pos)
         else:
             raise ValueError("unsupported whence value")
         return self._pos
 
-    def labelseek(self, key, back=1):
-        '''Pointer seeking by a label.
+    def labelseek(self, key, back=1, n=0):
+        '''Pointer seeking by a label, n is the number of label among ones
+        of the same name.
         '''
-        try:
-            p1, p2 = self._index[key]
-        except KeyError:
-            raise KeyError(f"label {key!r} doesn't exist")
-        self._pos = p1
+        record = self.label(key, n)
+        self._pos = record.offset
         if back == 0:
-            return p2
+            return record.offset + record.length
         else:
-            return p2 - p1
+            return record.length
 
     def unpack(self, fmt):
-        '''Unpack specific bytes stream using struct.unpack.
+        '''Unpack specific bytes stream using struct.unpack, fmt is a format
+        string or a precompiled struct.Struct object.
         '''
+        if isinstance(fmt, Struct):
+            packet = fmt.unpack_from(self._buf, self._pos)
+            self._pos += fmt.size
+            return packet
         size = calcsize(fmt)
         packet = unpack_from(fmt, self._buf, self._pos)
         self._pos += size
@@ -195,6 +937,8 @@ class AudioContextBuffer():
         return self._pos
 
     def truncate(self, pos=None):
+        if self._view is not None:
+            raise TypeError("can't truncate a mapped buffer")
         if pos is None:
             pos = self._pos
         else:
@@ -209,36 +953,489 @@ class AudioContextBuffer():
         del self._buf[pos:]
         return pos
         
-def bytes_to_file(path, *stream, exist_ok = False):
-    mode = 'wb'
-    if os.path.exists(path):
-        if exist_ok:
-            mode = 'ab'
-        else:
-            os.remove(path)
-    with open(path, mode) as f:
-        for cut in stream:
-            f.write(cut)
+class TagWriter():
+    """The base class of tag serializers.
+    Parts of a tag are collected in a list and only joined (or written by
+    os.writev) once, with the length known before the header is made.
+    """
+    def __init__(self, padding=0):
+        self._parts = []
+        self.length = 0
+        self.padding = padding
+
+    def _add(self, *parts):
+        for part in parts:
+            self._parts.append(part)
+            self.length += len(part)
 
-def copy_file(file1, file2, start = 0, ending = -1, exist_ok = False, buffer = 1024):
+    def header(self):
+        '''Return header of the tag according to collected parts.
+        '''
+        return b''
+
+    def trailer(self):
+        '''Return the parts following collected ones, the padding by default.
+        '''
+        return zero_parts(self.padding)
+
+    def parts(self):
+        '''Return a list of all parts of the tag in order.
+        '''
+        return [self.header(), *self._parts, *self.trailer()]
+
+    def getvalue(self):
+        '''Return the whole tag as bytes, copying each part only once.
+        '''
+        return b''.join(bytes(part) if isinstance(part, FilePart) else part
+                        for part in self.parts())
+
+    def __len__(self):
+        return sum(map(len, self.parts()))
+
+    def writeto(self, f):
+        '''Write the tag to current position of an unbuffered file object or
+        a file descriptor. Return the number of bytes written.
+        '''
+        return writeall(f, self.parts())
+
+_zeros = bytes(65536)
+
+def zero_parts(n):
+    '''Return a list of parts holding n zero bytes in total, which all
+    share one block of zeros.
+    '''
+    parts = []
+    while n > 0:
+        parts.append(memoryview(_zeros)[:n])
+        n -= len(_zeros)
+    return parts
+
+class FilePart():
+    """A range of a file taking the place of bytes in parts of a tag, e.g.
+    a picture to embed. It's copied to the output by copy_range when the
+    tag is written, so the data never passes through memory as a whole.
+    """
+    __slots__ = ('path', 'offset', 'length')
+
+    def __init__(self, path, offset=0, length=None):
+        if length is None:
+            length = os.stat(path).st_size - offset
+        self.path = path
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, key):
+        # only slices, e.g. cutting a written start
+        start, stop, step = key.indices(self.length)
+        return FilePart(self.path, self.offset + start, max(0, stop - start))
+
+    def __bytes__(self):
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            return f.read(self.length)
+
+    def __repr__(self):
+        return f"FilePart({self.path!r}, {self.offset}, {self.length})"
+
+def writeall(f, parts):
+    '''Write a sequence of bytes-like objects, or FilePart objects copied
+    from their files, to an unbuffered file object or a file descriptor,
+    gathered by os.writev where available.
+    Return the number of bytes written.
+    '''
+    fd = f if isinstance(f, int) else f.fileno()
+    parts = [part for part in parts if len(part)]
+    total = 0
+    with timed('write'):
+        start = 0
+        for i, part in enumerate(parts + [None]):
+            if part is not None and not isinstance(part, FilePart):
+                continue
+            total += _writeparts(fd, parts[start : i])
+            start = i + 1
+            if part is not None:
+                with open(part.path, 'rb') as src:
+                    n = copy_range(src, fd, part.offset, part.length)
+                if n < part.length:
+                    raise IOError(f"{part.path!r} is shorter than expected")
+                total += n
+    tally('bytes_written', total)
+    return total
+
+def _writeparts(fd, parts):
+    if hasattr(os, 'writev'):
+        return _writev(fd, parts)
+    total = 0
+    for part in parts:
+        view = memoryview(part)
+        while view:
+            n = os.write(fd, view)
+            tally('syscalls.write')
+            view = view[n:]
+            total += n
+    return total
+
+def _writev(fd, parts):
+    total = 0
+    i = 0
+    while i < len(parts):
+        n = os.writev(fd, parts[i : i + 1024])
+        tally('syscalls.writev')
+        total += n
+        # skip parts written completely, and cut the partially written one
+        while i < len(parts) and n >= len(parts[i]):
+            n -= len(parts[i])
+            i += 1
+        if n:
+            parts[i] = memoryview(parts[i])[n:]
+    return total
+
+def probe_image(source, size=4096):
+    '''Return an ImageInfo of a JPEG, PNG, GIF or WebP picture, given as
+    a path, a binary file object at its start or a bytes-like object, or
+    None if it's of other format.
+    Only the header (size bytes at most) is read, plus the segment headers
+    before the frame header of a JPEG.
+    '''
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return _probe(memoryview(source), None, 0)
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as f:
+            return _probe(f.read(size), f, 0)
+    pos = source.tell()
+    try:
+        return _probe(source.read(size), source, pos)
+    finally:
+        source.seek(pos)
+
+def _probe(head, f, base):
+    if head[:8] == b'\x89PNG\r\n\x1a\n' and head[12:16] == b'IHDR':
+        width, height, bits, ctype = unpack_from('!2I2B', head, 16)
+        # samples per pixel of gray, (none), RGB, indexed, gray-alpha, RGBA
+        channels = (1, 0, 3, 1, 2, 0, 4)[ctype] if ctype < 7 else 0
+        colors = 0
+        if ctype == 3:
+            # number of colors in PLTE chunk, the first one after IHDR
+            pos = 33
+            while pos + 8 <= len(head):
+                length, = unpack_from('!I', head, pos)
+                if head[pos + 4 : pos + 8] == b'PLTE':
+                    colors = length // 3
+                    break
+                if head[pos + 4 : pos + 8] == b'IDAT':
+                    break
+                pos += length + 12
+        return ImageInfo('image/png', width, height, bits * channels, colors)
+    elif head[:6] in (b'GIF87a', b'GIF89a') and len(head) >= 11:
+        width, height, flags = unpack_from('<2HB', head, 6)
+        bits = (flags & 7) + 1
+        colors = 1 << bits if flags & 0x80 else 0
+        return ImageInfo('image/gif', width, height, bits, colors)
+    elif head[:4] == b'RIFF' and head[8:12] == b'WEBP' and len(head) >= 30:
+        chunk = head[12:16]
+        if chunk == b'VP8 ':
+            width, height = unpack_from('<2H', head, 26)
+            return ImageInfo('image/webp', width & 0x3fff, height & 0x3fff, 24, 0)
+        elif chunk == b'VP8L':
+            bits, = unpack_from('<I', head, 21)
+            alpha = bits >> 28 & 1
+            return ImageInfo('image/webp', (bits & 0x3fff) + 1,
+                             (bits >> 14 & 0x3fff) + 1, 32 if alpha else 24, 0)
+        elif chunk == b'VP8X':
+            alpha = head[20] & 0x10
+            width = int.from_bytes(head[24:27], 'little') + 1
+            height = int.from_bytes(head[27:30], 'little') + 1
+            return ImageInfo('image/webp', width, height, 32 if alpha else 24, 0)
+    elif head[:2] == b'\xff\xd8':
+        return _probe_jpeg(head, f, base)
+    return None
+
+def _probe_jpeg(head, f, base):
+    # Walk through segments till a start of frame, reading segment headers
+    # from f at base if they are beyond head.
+    pos = 2
+    while True:
+        segment = head[pos : pos + 10]
+        if len(segment) < 10 and f is not None:
+            f.seek(base + pos)
+            segment = f.read(10)
+        if len(segment) < 4 or segment[0] != 0xff:
+            return None
+        marker = segment[1]
+        if marker == 0xff:
+            # fill byte
+            pos += 1
+            continue
+        length, = unpack_from('!H', segment, 2)
+        if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+            if len(segment) < 10:
+                return None
+            bits, height, width, components = unpack_from('!B2HB', segment, 4)
+            return ImageInfo('image/jpeg', width, height, bits * components, 0)
+        pos += 2 + length
+
+def picture_type(n):
+    '''Return description of a picture type number.
+    '''
+    try:
+        return _PICTURE_TYPES[n]
+    except IndexError:
+        raise IndexError("unkonwn picture type: %s" % n)
+
+def bytes_to_file(path, *stream, exist_ok = False, fsync = False):
+    '''Write stream to file, appended to it if exist_ok. Otherwise a file
+    is replaced atomically: the new one is written aside and then renamed
+    over it, so an interrupted write never leaves it truncated.
+    '''
+    if exist_ok and os.path.exists(path):
+        with open(path, 'ab', buffering=0) as f:
+            writeall(f, stream)
+            if fsync:
+                os.fsync(f.fileno())
+        return
+    f, tmppath = temp_file(path)
+    try:
+        with f:
+            writeall(f, stream)
+            if fsync:
+                os.fsync(f.fileno())
+        os.replace(tmppath, path)
+    except BaseException:
+        os.remove(tmppath)
+        raise
+
+def temp_file(path):
+    '''Create a temporary file beside path, to be renamed over it, with
+    permission of path if it exists. Return the unbuffered file object
+    and its path.
+    '''
+    dirpath, name = os.path.split(os.path.abspath(path))
+    while True:
+        tmppath = os.path.join(dirpath, f'.{name}.{os.urandom(4).hex()}.tmp')
+        try:
+            fd = os.open(tmppath, os.O_WRONLY | os.O_CREAT | os.O_EXCL |
+                         getattr(os, 'O_BINARY', 0), 0o666)
+        except FileExistsError:
+            continue
+        break
+    try:
+        os.chmod(tmppath, stat.S_IMODE(os.stat(path).st_mode))
+    except FileNotFoundError:
+        pass
+    return open(fd, 'wb', buffering=0), tmppath
+
+def fsync_dir(dirpath):
+    '''Flush a directory entry, making renames in it durable.
+    It's a no-op on platforms which can't open directories.
+    '''
+    try:
+        fd = os.open(dirpath or '.', os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def copy_file(file1, file2, start = 0, ending = -1, exist_ok = False,
+              buffer = 1 << 20, reflink = True):
+    '''Copy bytes of file2 from start till ending (the end by default) to
+    file1, appended to it if exist_ok, or replacing it otherwise.
+    The data is cloned by reflink where the file system supports it, or
+    copied inside the kernel, see copy_range.
+    Return the number of bytes copied.
+    '''
     if ending >= 0 and ending <= start:
         raise ValueError("invalid start-ending of read")
     mode = 'wb'
     if os.path.exists(file1):
         if exist_ok:
-            mode = 'ab'
+            # not 'ab', as copy_file_range refuses files opened for append
+            mode = 'r+b'
         else:
             os.remove(file1)
     if ending < 0:
         length = os.path.getsize(file2) - start
     else:
         length = min(os.path.getsize(file2), ending) - start
+    if length <= 0:
+        return 0
     with open(file2, 'rb') as f:
-        f.seek(start)
-        with open(file1, mode) as _f:
-            while True:
-                _f.write(f.read(buffer))
-                length -= buffer
-                if length <= 0:
-                    break
+        with open(file1, mode, buffering=0) as _f:
+            _f.seek(0, 2)
+            return copy_range(f, _f, start, length, buffer, reflink)
+
+def write_in_place(path, offset, *stream, skip=0, copy=False):
+    '''Overwrite part of an existing file from offset, leaving the rest
+    of it untouched. skip bytes at the start of stream, known to be in the
+    file already, aren't written again.
+    With copy, the parts are copied before written, which is needed when
+    they are views of a mapping of the same file.
+    '''
+    stream = list(stream)
+    i = 0
+    while i < len(stream) and skip >= len(stream[i]):
+        skip -= len(stream[i])
+        offset += len(stream[i])
+        tally('bytes_skipped', len(stream[i]))
+        i += 1
+    stream = stream[i:]
+    if stream and skip:
+        if not isinstance(stream[0], FilePart):
+            stream[0] = memoryview(stream[0])
+        stream[0] = stream[0][skip:]
+        offset += skip
+        tally('bytes_skipped', skip)
+    if copy:
+        stream = [part if isinstance(part, FilePart) else bytes(part)
+                  for part in stream]
+    with open(path, 'r+b', buffering=0) as f:
+        f.seek(offset)
+        writeall(f, stream)
+
+def write_ranges(path, ranges, copy=False):
+    '''Overwrite several ranges of an existing file, given as a list of
+    (offset, parts), leaving the rest of it untouched. copy is as
+    write_in_place takes.
+    '''
+    with open(path, 'r+b', buffering=0) as f:
+        for offset, parts in ranges:
+            if copy:
+                parts = [part if isinstance(part, FilePart) else bytes(part)
+                         for part in parts]
+            f.seek(offset)
+            writeall(f, parts)
+
+def rewrite_file(path, start, *stream, fsync = False):
+    '''Replace the first start bytes of a file by the given stream.
+    The new file is built aside in the same directory and then renamed over
+    the original one, so it's either the old or the new file after a crash.
+    With fsync, the new file is flushed to disk before renamed; fsync the
+    directory by fsync_dir to make the rename itself durable.
+    '''
+    f, tmppath = temp_file(path)
+    try:
+        with f:
+            writeall(f, stream)
+            with open(path, 'rb') as src:
+                length = os.fstat(src.fileno()).st_size - start
+                if length > 0:
+                    copy_range(src, f, start, length, reflink = True)
+            if fsync:
+                os.fsync(f.fileno())
+        os.replace(tmppath, path)
+    except BaseException:
+        os.remove(tmppath)
+        raise
+
+def copy_range(src, dst, offset, count, buffer = 1 << 20, reflink = False):
+    '''Copy count bytes from offset of src to the current position of dst.
+    Both are file objects or file descriptors. The copy is done inside the
+    kernel by copy_file_range or sendfile where available, otherwise via
+    a reusable buffer. With reflink, the block-aligned part of data is
+    first tried to be shared by FICLONERANGE (Btrfs, XFS etc.).
+    Return the number of bytes copied.
+    '''
+    if hasattr(dst, 'flush'):
+        dst.flush()
+    infd = src if isinstance(src, int) else src.fileno()
+    outfd = dst if isinstance(dst, int) else dst.fileno()
+    with timed('copy'):
+        copied = _copy_range(infd, outfd, offset, count, buffer, reflink)
+    tally('bytes_copied', copied)
+    return copied
+
+def _copy_range(infd, outfd, offset, count, buffer, reflink):
+    copied = 0
+    methods = (_copy_file_range, _sendfile)
+    if reflink:
+        methods = (_clone_range,) + methods
+    for func in methods:
+        try:
+            copied += func(infd, outfd, offset + copied, count - copied)
+        except OSError as e:
+            # unsupported by platform or file system, or failed midway
+            # after copying some bytes: try next method from there
+            copied += getattr(e, 'copied', 0)
+            continue
+        if copied >= count:
+            return copied
+    copied += _readinto(infd, outfd, offset + copied, count - copied, buffer)
+    return copied
+
+# _IOW(0x94, 13, struct file_clone_range) of linux/fs.h
+_FICLONERANGE = 0x4020940d
+
+def _clone_range(infd, outfd, offset, count):
+    try:
+        import fcntl
+    except ImportError:
+        raise OSError("FICLONERANGE unavailable")
+    import struct
+    if not hasattr(fcntl, 'ioctl') or not sys.platform.startswith('linux'):
+        raise OSError("FICLONERANGE unavailable")
+    dstpos = os.lseek(outfd, 0, os.SEEK_CUR)
+    blksize = os.fstat(outfd).st_blksize
+    if offset % blksize or dstpos % blksize:
+        raise OSError("range isn't aligned to file system blocks")
+    if offset + count < os.fstat(infd).st_size:
+        # only the end of file may be unaligned
+        count -= count % blksize
+    if count == 0:
+        return 0
+    tally('syscalls.ioctl')
+    fcntl.ioctl(outfd, _FICLONERANGE,
+                struct.pack('=qQQQ', infd, offset, count, dstpos))
+    os.lseek(outfd, dstpos + count, os.SEEK_SET)
+    return count
+
+def _copy_file_range(infd, outfd, offset, count):
+    if not hasattr(os, 'copy_file_range'):
+        raise OSError("copy_file_range unavailable")
+    copied = 0
+    try:
+        while copied < count:
+            n = os.copy_file_range(infd, outfd, count - copied, offset + copied)
+            tally('syscalls.copy_file_range')
+            if n == 0: break
+            copied += n
+    except OSError as e:
+        e.copied = copied
+        raise
+    return copied
+
+def _sendfile(infd, outfd, offset, count):
+    if not hasattr(os, 'sendfile'):
+        raise OSError("sendfile unavailable")
+    copied = 0
+    try:
+        while copied < count:
+            n = os.sendfile(outfd, infd, offset + copied, count - copied)
+            tally('syscalls.sendfile')
+            if n == 0: break
+            copied += n
+    except OSError as e:
+        e.copied = copied
+        raise
+    return copied
 
+def _readinto(infd, outfd, offset, count, buffer):
+    view = memoryview(bytearray(min(buffer, count)))
+    copied = 0
+    with open(infd, 'rb', buffering=0, closefd=False) as f:
+        f.seek(offset)
+        while copied < count:
+            n = f.readinto(view[:count - copied])
+            tally('syscalls.read')
+            if not n: break
+            pos = 0
+            while pos < n:
+                pos += os.write(outfd, view[pos:n])
+                tally('syscalls.write')
+            copied += n
+    return copied